@@ -0,0 +1,267 @@
+"""Benchmarks for the hot paths in bot.py.
+
+Seed a database with a synthetic player base, run the benchmarks against a
+copy of it and compare two JSON reports, failing when something got slower:
+
+    python bench.py seed --users 100k --db data/bench.db
+    python bench.py run --db data/bench.db --out bench.json
+    python bench.py compare base.json bench.json --threshold 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:bench')
+
+import bot
+
+SIZE_SUFFIXES = {'k': 1_000, 'm': 1_000_000}
+SEED_BATCH = 10_000
+
+def parse_size(value):
+    """'10k' -> 10000, '1M' -> 1000000"""
+    value = value.strip().lower()
+    if value[-1:] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+def _synthetic_users(count, rng, now):
+    """Mostly one-off players with a heavy tail of regulars"""
+    for user_id in range(1, count + 1):
+        if rng.random() < 0.6:
+            attempts = rng.randint(1, 4)
+        else:
+            attempts = min(5000, int(5 * rng.paretovariate(1.2)))
+        correct = int(attempts * rng.uniform(0.5, 0.98))
+        points = int(correct * rng.uniform(15, 45))
+        last_activity = now - timedelta(days=rng.expovariate(1 / 30), seconds=rng.randint(0, 86400))
+        yield (
+            user_id,
+            user_id if rng.random() < 0.7 else None,
+            f"user{user_id}" if rng.random() < 0.5 else None,
+            f"Игрок{user_id}",
+            correct,
+            attempts,
+            points,
+            bot.get_user_level(points),
+            last_activity.strftime('%Y-%m-%d %H:%M:%S'),
+        )
+
+def _synthetic_activity(users, rng, now, per_user_cap):
+    """user_activity rows proportional to each user's correct answers"""
+    for user_id, _, _, _, correct, _, points, _, last_activity in users:
+        rows = min(correct, per_user_cap)
+        if rows == 0:
+            continue
+        last = datetime.strptime(last_activity, '%Y-%m-%d %H:%M:%S')
+        share = max(1, points // rows)
+        for _ in range(rows):
+            at = last - timedelta(days=rng.expovariate(1 / 7), seconds=rng.randint(0, 3600))
+            yield user_id, share, at.strftime('%Y-%m-%d %H:%M:%S')
+
+def seed(db_path, users, per_user_cap=20, seed_value=42):
+    """Create a fresh database with users and a proportional activity history"""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    bot.DB_PATH = db_path
+    bot.init_database()
+
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    generated = _synthetic_users(users, rng, now)
+    activity_rows = 0
+    while True:
+        batch = [row for _, row in zip(range(SEED_BATCH), generated)]
+        if not batch:
+            break
+        conn.executemany('''
+        INSERT INTO users (user_id, chat_id, username, first_name, total_correct, total_attempts,
+                           total_points, level, last_activity)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+        activity = list(_synthetic_activity(batch, rng, now, per_user_cap))
+        conn.executemany('INSERT INTO user_activity (user_id, points, activity_time) VALUES (?, ?, ?)', activity)
+        activity_rows += len(activity)
+        conn.commit()
+    conn.close()
+    return {'users': users, 'activity_rows': activity_rows}
+
+class _StubQuery:
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+class _StubUpdate:
+    callback_query = _StubQuery()
+    message = None
+    effective_user = None
+
+class _StubContext:
+    def __init__(self):
+        self.user_data = {}
+
+def _measure(call, number):
+    started = time.perf_counter()
+    for _ in range(number):
+        call()
+    return (time.perf_counter() - started) / number
+
+def _measure_async(call, number):
+    async def batch():
+        started = time.perf_counter()
+        for _ in range(number):
+            await call()
+        return (time.perf_counter() - started) / number
+    return asyncio.run(batch())
+
+def benchmarks(user_count, rng):
+    """name -> (callable, is_async, calls per repeat)"""
+    update, context = _StubUpdate(), _StubContext()
+    answers = [12, 15, 18, 21]
+
+    def random_user():
+        return rng.randint(1, user_count)
+
+    return {
+        'create_question': (lambda: bot.create_question(update, context, 'normal', rng.choice(['easy', 'medium', 'hard', 'genius'])), True, 2000),
+        'generate_wrong_answers': (lambda: bot.generate_wrong_answers(rng.randint(1, 10000)), False, 5000),
+        'update_user_stats': (lambda: bot.update_user_stats(random_user(), 'bench', 'Bench', None, rng.random() < 0.8, 30), False, 200),
+        'get_user_rank': (lambda: bot.get_user_rank(random_user()), False, 1000),
+        'get_global_rating': (lambda: bot.get_global_rating(15), False, 5000),
+        'get_total_users': (bot.get_total_users, False, 5000),
+        'snapshot_refresh': (bot.refresh_snapshot, False, 3),
+        'daily_rating_query': (lambda: bot.get_daily_rating(bot.DAILY_BOARD_SIZE), False, 10),
+        'render_global_rating': (bot.render_global_rating, False, 500),
+        'render_daily_rating': (bot.render_daily_rating, False, 10),
+        'main_menu_keyboard': (bot.main_menu_keyboard, False, 5000),
+        'question_keyboard': (lambda: bot.question_keyboard(answers), False, 5000),
+        'after_answer_keyboard': (lambda: bot.after_answer_keyboard('medium', True), False, 5000),
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(db_path, repeat=5, only=None, in_place=False):
+    """Run the benchmarks on a copy of db_path and return a report"""
+    target = db_path
+    if not in_place:
+        handle, target = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        shutil.copyfile(db_path, target)
+    bot.DB_PATH = target
+    # Reads hit the snapshot as in production, snapshot_refresh times the rebuild
+    bot.SNAPSHOT_MAX_AGE = float('inf')
+    try:
+        bot.init_database()
+        bot.refresh_snapshot()
+        conn = sqlite3.connect(target)
+        user_count = conn.execute('SELECT MAX(user_id) FROM users').fetchone()[0] or 1
+        activity_rows = conn.execute('SELECT COUNT(*) FROM user_activity').fetchone()[0]
+        conn.close()
+
+        rng = random.Random(0)
+        results = {}
+        for name, (call, is_async, number) in benchmarks(user_count, rng).items():
+            if only and name not in only:
+                continue
+            measure = _measure_async if is_async else _measure
+            measure(call, max(1, number // 10))  # warm up
+            samples = [measure(call, number) for _ in range(repeat)]
+            results[name] = {
+                'calls': number,
+                'repeat': repeat,
+                'min_us': round(min(samples) * 1e6, 3),
+                'median_us': round(statistics.median(samples) * 1e6, 3),
+                'mean_us': round(statistics.fmean(samples) * 1e6, 3),
+            }
+            print(f"{name:24} {results[name]['median_us']:>12.1f} µs", file=sys.stderr)
+    finally:
+        if not in_place:
+            os.remove(target)
+
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'users': user_count,
+            'activity_rows': activity_rows,
+            'created_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        },
+        'results': results,
+    }
+
+def compare(base, new, threshold):
+    """Rows of (name, base µs, new µs, change %, regressed?) by median time"""
+    rows = []
+    for name, result in new['results'].items():
+        if name not in base['results']:
+            continue
+        old_value, new_value = base['results'][name]['median_us'], result['median_us']
+        change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+        rows.append((name, old_value, new_value, change, change > threshold))
+    return rows
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the bot's hot paths")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help="generate a synthetic database")
+    seed_parser.add_argument('--users', type=parse_size, default=parse_size('10k'), help="e.g. 10k, 100k, 1M")
+    seed_parser.add_argument('--db', default='bench.db')
+    seed_parser.add_argument('--activity-cap', type=int, default=20, help="max user_activity rows per user")
+    seed_parser.add_argument('--seed', type=int, default=42)
+
+    run_parser = commands.add_parser('run', help="run benchmarks and write a JSON report")
+    run_parser.add_argument('--db', default='bench.db')
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--only', nargs='*', help="benchmark names to run")
+    run_parser.add_argument('--in-place', action='store_true', help="write to --db instead of a copy")
+    run_parser.add_argument('--out', help="write the JSON report here instead of stdout")
+
+    compare_parser = commands.add_parser('compare', help="compare two reports, exit 1 on regression")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10.0, help="allowed slowdown in percent")
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        started = time.perf_counter()
+        stats = seed(args.db, args.users, args.activity_cap, args.seed)
+        print(f"Seeded {stats['users']} users and {stats['activity_rows']} activity rows "
+              f"into {args.db} in {time.perf_counter() - started:.1f} s")
+    elif args.command == 'run':
+        report = json.dumps(run(args.db, args.repeat, args.only, args.in_place), indent=2)
+        if args.out:
+            with open(args.out, 'w') as out:
+                out.write(report + '\n')
+        else:
+            print(report)
+    else:
+        with open(args.base) as base, open(args.new) as new:
+            rows = compare(json.load(base), json.load(new), args.threshold)
+        regressed = False
+        for name, old_value, new_value, change, slower in rows:
+            regressed = regressed or slower
+            print(f"{name:24} {old_value:>12.1f} -> {new_value:<12.1f} µs {change:+7.1f}% {'❌' if slower else '✅'}")
+        sys.exit(1 if regressed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,26 @@
+import bisect
+import itertools
 import logging
 import random
 import asyncio
 import time
 import sqlite3
 import os
+from collections import namedtuple
 from pathlib import Path
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, CallbackContext
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, CallbackContext, TypeHandler
+from replay import ArrivalQueue, UpdateRecorder
+from profiler import LoopWatchdog, SamplingProfiler, format_collapsed, top_frames
+from outbound import OutboundBot, format_stats, tracked
 
 # Настройка путей для Docker
 BASE_DIR = Path(__file__).parent
 DB_PATH = os.getenv('DB_PATH', 'multiplication_game.db')
+# Opt-in traffic recording for replay.py, off unless a log path is given
+RECORD_UPDATES = os.getenv('RECORD_UPDATES')
 
 # Простая настройка логирования
 logging.basicConfig(
@@ -36,10 +45,87 @@ ACHIEVEMENTS = {
     'accuracy_90': {'name': '🎯 Снайпер', 'description': 'Достичь точности 90%'},
 }
 
-def init_database():
+# Telegram user ids allowed to use the /watchdog and /profile commands
+ADMIN_IDS = {int(uid) for uid in os.getenv('ADMIN_IDS', '').split(',') if uid.strip()}
+
+# Profiling surface, see profiler.py. The watchdog starts with the bot when
+# LOOP_WATCHDOG=1, otherwise admins switch it on with /watchdog on
+WATCHDOG = LoopWatchdog(threshold=float(os.getenv('LOOP_STALL_THRESHOLD_MS', '200')) / 1000)
+PROFILER = SamplingProfiler()
+MAX_PROFILE_SECONDS = 120
+
+# Outbound HTTP pool shared by all handlers. Requests wait up to
+# BOT_POOL_TIMEOUT seconds for a free connection during bursts.
+BOT_POOL_SIZE = int(os.getenv('BOT_POOL_SIZE', '64'))
+BOT_POOL_TIMEOUT = float(os.getenv('BOT_POOL_TIMEOUT', '5'))
+
+# Leaderboard summaries from other shards when running under shard.py,
+# keyed by shard index. Empty in the regular single-process mode.
+PEER_BOARDS = {}
+
+# Ranked leaderboard materialized from the users table so reads do not
+# contend with answer writes. Swapped as a whole, never mutated in place.
+LeaderboardSnapshot = namedtuple('LeaderboardSnapshot', 'rows points_asc at_or_above total built_at')
+SNAPSHOT_MAX_AGE = float(os.getenv('SNAPSHOT_MAX_AGE', '30'))
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '10'))
+SNAPSHOT_TOP = int(os.getenv('SNAPSHOT_TOP', '100'))
+# Players need this many attempts to appear in the rating
+RATED_ATTEMPTS = 5
+_snapshot = None
+_snapshot_local = None
+
+# Rendered leaderboards. A board's version is bumped whenever a write could
+# change what it shows; board -> ((version, day), text, markup, board state)
+GLOBAL_BOARD_SIZE = 15
+DAILY_BOARD_SIZE = 10
+LEADERBOARD_VERSION = {'global': 0, 'daily': 0}
+_RENDER_CACHE = {}
+
+# Hot/cold tiering: users without activity for ARCHIVE_AFTER_DAYS are moved
+# to *_cold tables and restored on their next /start or answer. 0 disables it.
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_BATCH_SIZE = 500  # stays under SQLite's limit of bound parameters
+_TIERED_TABLES = [
+    ('users', 'users_cold',
+     'user_id, chat_id, username, first_name, last_name, total_correct, total_attempts, total_points, level, last_activity'),
+    ('achievements', 'achievements_cold', 'user_id, achievement_id, achieved_at'),
+    # Activity ids are left to each table: they are renumbered by shard.py
+    # merges, so carrying them over could replace another user's rows
+    ('user_activity', 'user_activity_cold', 'user_id, points, activity_time'),
+]
+
+# Duel mode: players wait in a queue per level from get_user_level and are
+# paired first come, first served. Matches live only in this process, so
+# shard.py switches duels off when it runs more than one worker.
+DUELS_ENABLED = True
+DUEL_ROUNDS = 5
+DUEL_ROUND_SECONDS = 15
+DUEL_SEARCH_SECONDS = 60
+DUEL_FLUSH_INTERVAL = 10
+DUEL_DIFFICULTY = {
+    "🎒 Новичок": 'easy',
+    "🎓 Ученик": 'medium',
+    "🥉 Бронза": 'medium',
+    "🥈 Серебро": 'hard',
+    "🥇 Золото": 'hard',
+    "💎 Алмаз": 'genius',
+}
+_duel_queues = {}  # level -> {user_id: (name, chat_id, message_id)}, oldest first
+_waiting_level = {}  # user_id -> level they are queued in
+_search_timers = {}  # user_id -> task giving up their search after DUEL_SEARCH_SECONDS
+_duels = {}  # duel_id -> Duel
+_player_duels = {}  # user_id -> Duel
+_duel_ids = itertools.count(1)
+_finished_duels = []  # rows for the duels table, written in batches
+
+# Long-running tasks started in post_init
+BACKGROUND_TASKS = []
+
+def init_database(db_path=None):
     """Initialize the database with error handling"""
+    db_path = db_path or DB_PATH
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
         
         # Create users table
@@ -80,14 +166,130 @@ def init_database():
         )
         ''')
         
+        # Create finished duels table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS duels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player1 INTEGER,
+            player2 INTEGER,
+            score1 INTEGER,
+            score2 INTEGER,
+            winner INTEGER,
+            finished_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_activity_user
+        ON user_activity (user_id, activity_time)
+        ''')
+        
+        # Cold tier: players inactive for ARCHIVE_AFTER_DAYS, see archive_inactive_users
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_last_activity
+        ON users (last_activity)
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users_cold (
+            user_id INTEGER PRIMARY KEY,
+            chat_id INTEGER,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            total_correct INTEGER DEFAULT 0,
+            total_attempts INTEGER DEFAULT 0,
+            total_points INTEGER DEFAULT 0,
+            level TEXT DEFAULT 'Новичок',
+            last_activity TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS achievements_cold (
+            user_id INTEGER,
+            achievement_id TEXT,
+            achieved_at TIMESTAMP,
+            PRIMARY KEY (user_id, achievement_id)
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity_cold (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            points INTEGER,
+            activity_time TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_activity_cold_user
+        ON user_activity_cold (user_id)
+        ''')
+        
         conn.commit()
         conn.close()
-        logger.info(f"Database initialized successfully at: {DB_PATH}")
+        logger.info(f"Database initialized successfully at: {db_path}")
         
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
         raise
 
+def archive_inactive_users(days=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move users inactive for more than `days` to the cold tables, in batches"""
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    moved = 0
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    try:
+        while True:
+            cursor.execute('''
+            SELECT user_id FROM users
+            WHERE last_activity < datetime('now', ?)
+            LIMIT ?
+            ''', (f'-{days} days', batch_size))
+            user_ids = [row[0] for row in cursor.fetchall()]
+            if not user_ids:
+                break
+            
+            for source, target, columns in _TIERED_TABLES:
+                _move_rows(cursor, source, target, columns, user_ids)
+            conn.commit()
+            moved += len(user_ids)
+    finally:
+        conn.close()
+    
+    if moved:
+        logger.info(f"Archived {moved} users inactive for {days}+ days")
+    return moved
+
+def _restore_user(cursor, user_id):
+    """Bring an archived user back to the hot tables; True if one was restored"""
+    cursor.execute('SELECT 1 FROM users_cold WHERE user_id = ?', (user_id,))
+    if cursor.fetchone() is None:
+        return False
+    for hot, cold, columns in _TIERED_TABLES:
+        _move_rows(cursor, cold, hot, columns, [user_id])
+    # Count the comeback as activity so the next archive run keeps them hot
+    cursor.execute('UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
+    logger.info(f"Restored archived user {user_id}")
+    return True
+
+def _move_rows(cursor, source, target, columns, user_ids):
+    placeholders = ','.join('?' * len(user_ids))
+    cursor.execute(
+        f'INSERT OR REPLACE INTO {target} ({columns}) SELECT {columns} FROM {source} WHERE user_id IN ({placeholders})',
+        user_ids
+    )
+    cursor.execute(f'DELETE FROM {source} WHERE user_id IN ({placeholders})', user_ids)
+
+async def archive_task(application: Application) -> None:
+    """Archive inactive users once a day off the event loop"""
+    while True:
+        try:
+            await asyncio.to_thread(archive_inactive_users)
+        except Exception as e:
+            logger.error(f"Archive error: {e}")
+        await asyncio.sleep(60*60*24)
+
 def get_user_level(points):
     """Determine user level based on points"""
     if points < 100:
@@ -111,7 +313,7 @@ def update_user_stats(user_id, username, first_name, last_name, correct=False, p
         
         # Check if user exists
         cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        if cursor.fetchone() is None:
+        if cursor.fetchone() is None and not _restore_user(cursor, user_id):
             # Create new user
             chat_id = None
             try:
@@ -148,6 +350,7 @@ def update_user_stats(user_id, username, first_name, last_name, correct=False, p
             WHERE user_id = ?
             ''', (user_id,))
         
+        _invalidate_after_answer(cursor, user_id, correct, points)
         conn.commit()
         conn.close()
         
@@ -157,59 +360,266 @@ def update_user_stats(user_id, username, first_name, last_name, correct=False, p
 def get_global_rating(limit=10):
     """Get global rating of top users"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT user_id, username, first_name, total_points, total_correct, total_attempts,
-               CASE WHEN total_attempts > 0 THEN (total_correct * 100.0 / total_attempts) ELSE 0 END as accuracy
-        FROM users 
-        WHERE total_attempts >= 5
-        ORDER BY total_points DESC 
-        LIMIT ?
-        ''', (limit,))
-        
-        results = cursor.fetchall()
-        conn.close()
-        return results
+        return list(current_snapshot().rows[:limit])
     except Exception as e:
         logger.error(f"Error getting global rating: {e}")
         return []
 
-def get_user_rank(user_id):
-    """Get user's global rank"""
+def get_user_rank(user_id, points=None):
+    """Get user's global rank; pass points when the caller already has them"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT COUNT(*) + 1 
-        FROM users 
-        WHERE total_points > (SELECT total_points FROM users WHERE user_id = ?)
-        AND total_attempts >= 5
-        ''', (user_id,))
-        
-        rank = cursor.fetchone()[0]
-        conn.close()
-        return rank
+        if points is None:
+            conn = sqlite3.connect(DB_PATH)
+            cursor = conn.cursor()
+            cursor.execute('SELECT total_points FROM users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            conn.close()
+            if row is None:
+                return 1
+            points = row[0]
+        return _rank_of(current_snapshot(), points)
     except Exception as e:
         logger.error(f"Error getting user rank: {e}")
         return 0
 
+def get_rank_and_total(points, attempts, just_answered=False):
+    """Rank of a player's current points and a player count that agrees with it.
+
+    The snapshot can predate the player entering the rating. When this very
+    answer took them to RATED_ATTEMPTS they are counted in, and the total is
+    never shown below the rank.
+    """
+    try:
+        snapshot = current_snapshot()
+        rank = _rank_of(snapshot, points)
+        total = snapshot.total
+        if just_answered and attempts == RATED_ATTEMPTS:
+            total += 1
+        return rank, max(total, rank)
+    except Exception as e:
+        logger.error(f"Error getting user rank: {e}")
+        return 0, 0
+
 def get_total_users():
     """Get total number of active users"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM users WHERE total_attempts >= 5')
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        return current_snapshot().total
     except Exception as e:
         logger.error(f"Error getting total users: {e}")
         return 0
 
+def current_snapshot():
+    """Latest leaderboard snapshot, rebuilt inline if older than SNAPSHOT_MAX_AGE.
+
+    When the rebuild fails the last good snapshot is kept and returned; only
+    a process that never built one sees the error.
+    """
+    if _snapshot is None or time.time() - _snapshot.built_at > SNAPSHOT_MAX_AGE:
+        try:
+            refresh_snapshot()
+        except Exception as e:
+            if _snapshot is None:
+                raise
+            logger.error(f"Snapshot rebuild failed, serving the previous one: {e}")
+    return _snapshot
+
+def snapshot_age_note():
+    """How old the leaderboard data on screen is, empty if there is none"""
+    try:
+        age = int(time.time() - current_snapshot().built_at)
+    except Exception as e:
+        logger.error(f"Error getting snapshot age: {e}")
+        return ""
+    return f"\n\n🕒 Обновлено {age} с назад"
+
+def refresh_snapshot(local=None):
+    """Build a new snapshot (querying the database unless given a local part) and swap it in"""
+    global _snapshot_local
+    if local is None:
+        local = _query_local_leaderboard()
+    _snapshot_local = local
+    _swap_snapshot(_assemble_snapshot(local))
+
+def _query_local_leaderboard():
+    """Top rows and a points histogram of this process's database"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    built_at = time.time()
+    
+    cursor.execute('''
+    SELECT user_id, username, first_name, total_points, total_correct, total_attempts,
+           CASE WHEN total_attempts > 0 THEN (total_correct * 100.0 / total_attempts) ELSE 0 END as accuracy
+    FROM users 
+    WHERE total_attempts >= ?
+    ORDER BY total_points DESC 
+    LIMIT ?
+    ''', (RATED_ATTEMPTS, SNAPSHOT_TOP))
+    rows = cursor.fetchall()
+    
+    cursor.execute('''
+    SELECT total_points, COUNT(*)
+    FROM users
+    WHERE total_attempts >= ?
+    GROUP BY total_points
+    ''', (RATED_ATTEMPTS,))
+    histogram = cursor.fetchall()
+    conn.close()
+    return rows, histogram, built_at
+
+def _assemble_snapshot(local):
+    """Combine the local part with boards from other shards into an immutable snapshot"""
+    rows, histogram, built_at = local
+    counts = dict(histogram)
+    if PEER_BOARDS:
+        rows = _merge_top(rows, (board['top'] for board in PEER_BOARDS.values()), SNAPSHOT_TOP)
+        for board in PEER_BOARDS.values():
+            for points, count in board['histogram']:
+                counts[points] = counts.get(points, 0) + count
+    
+    points_asc = sorted(counts)
+    at_or_above = [0] * (len(points_asc) + 1)
+    for i in range(len(points_asc) - 1, -1, -1):
+        at_or_above[i] = at_or_above[i + 1] + counts[points_asc[i]]
+    
+    return LeaderboardSnapshot(
+        rows=tuple(rows),
+        points_asc=tuple(points_asc),
+        at_or_above=tuple(at_or_above),
+        total=at_or_above[0],
+        built_at=built_at,
+    )
+
+def _swap_snapshot(snapshot):
+    """Publish a snapshot; readers only ever see a complete one"""
+    global _snapshot
+    previous = _snapshot
+    _snapshot = snapshot
+    if (previous is None or previous.total != snapshot.total
+            or previous.rows[:GLOBAL_BOARD_SIZE] != snapshot.rows[:GLOBAL_BOARD_SIZE]):
+        bump_leaderboard('global')
+
+def _rank_of(snapshot, points):
+    """1 + number of active players with more points"""
+    return 1 + snapshot.at_or_above[bisect.bisect_right(snapshot.points_asc, points)]
+
+async def snapshot_refresher(application: Application) -> None:
+    """Keep the leaderboard snapshot fresh off the event loop"""
+    while True:
+        try:
+            local = await asyncio.to_thread(_query_local_leaderboard)
+            refresh_snapshot(local)
+        except Exception as e:
+            logger.error(f"Snapshot refresh error: {e}")
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+
+def get_daily_rating(limit=10):
+    """Get today's top users by points earned"""
+    results = _local_daily_rating(limit)
+    if PEER_BOARDS:
+        results = _merge_top(results, (board['daily'] for board in PEER_BOARDS.values()), limit)
+    return results
+
+def _local_daily_rating(limit):
+    """Query today's top users from this process's database only"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    SELECT u.user_id, u.username, u.first_name, SUM(ua.points) as daily_points
+    FROM user_activity ua
+    JOIN users u ON ua.user_id = u.user_id
+    WHERE date(ua.activity_time) = date('now')
+    GROUP BY ua.user_id 
+    ORDER BY daily_points DESC 
+    LIMIT ?
+    ''', (limit,))
+    
+    results = cursor.fetchall()
+    conn.close()
+    return results
+
+def get_local_board():
+    """Summarize this database's leaderboard for exchange with other shards"""
+    rows, histogram, _ = _query_local_leaderboard()
+    return {
+        'top': rows,
+        'daily': _local_daily_rating(DAILY_BOARD_SIZE),
+        'histogram': histogram,
+    }
+
+def set_peer_board(shard, board):
+    """Store the leaderboard summary received from another shard"""
+    if PEER_BOARDS.get(shard) == board:
+        return
+    PEER_BOARDS[shard] = board
+    bump_leaderboard('daily')
+    if _snapshot_local is not None:
+        _swap_snapshot(_assemble_snapshot(_snapshot_local))
+
+def _merge_top(local_rows, peer_rows, limit):
+    """Merge ranked rows from several shards, ordered by points (4th column)"""
+    rows = list(local_rows)
+    for peer in peer_rows:
+        rows.extend(tuple(row) for row in peer)
+    rows.sort(key=lambda row: row[3], reverse=True)
+    return rows[:limit]
+
+def _board_state(rows, size):
+    """What a rendered board depends on: member ids, lowest points, full or not"""
+    return {
+        'members': {row[0] for row in rows},
+        'cutoff': rows[-1][3] if rows else 0,
+        'full': len(rows) >= size,
+    }
+
+def _today():
+    # SQLite's date('now') is UTC, the daily board follows it
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+def cached_board(board, render):
+    """Rendered (text, markup) for a board, rebuilt only when its version moved.
+
+    render returns (text, markup, state), state being what _could_change
+    checks, or None for a board invalidated elsewhere. Errors from render
+    propagate and leave the cache untouched, so a failed read is never
+    served as an empty board.
+    """
+    key = (LEADERBOARD_VERSION[board], _today() if board == 'daily' else None)
+    cached = _RENDER_CACHE.get(board)
+    if cached and cached[0] == key:
+        return cached[1], cached[2]
+    
+    text, markup, state = render()
+    _RENDER_CACHE[board] = (key, text, markup, state)
+    return text, markup
+
+def bump_leaderboard(*boards):
+    """Invalidate rendered boards; with no arguments invalidates all of them"""
+    for board in boards or LEADERBOARD_VERSION:
+        LEADERBOARD_VERSION[board] += 1
+
+def _could_change(board, user_id, points):
+    """Whether a player with this score now would appear on or alter a cached board"""
+    cached = _RENDER_CACHE.get(board)
+    if cached is None:
+        return False
+    state = cached[3]
+    return user_id in state['members'] or not state['full'] or points >= state['cutoff']
+
+def _invalidate_after_answer(cursor, user_id, correct, points):
+    """Bump the daily board version if the answer just written can affect it.
+    
+    The all-time board follows the snapshot and is bumped when one is swapped in.
+    """
+    if correct and points > 0 and _RENDER_CACHE.get('daily'):
+        cursor.execute('''
+        SELECT SUM(points) FROM user_activity
+        WHERE user_id = ? AND date(activity_time) = date('now')
+        ''', (user_id,))
+        daily_points = cursor.fetchone()[0] or 0
+        if _could_change('daily', user_id, daily_points):
+            bump_leaderboard('daily')
+
 def main_menu_keyboard():
     """Create main menu keyboard with Russian text"""
     keyboard = [
@@ -218,12 +628,13 @@ def main_menu_keyboard():
         [InlineKeyboardButton("Сложный (5-50) 🔴", callback_data='hard')],
         [InlineKeyboardButton("Гений (10-100) 🧠", callback_data='genius')],
         [InlineKeyboardButton("Соревнование ⏱️", callback_data='competition')],
+        [InlineKeyboardButton("Дуэль ⚔️", callback_data='duel')] if DUELS_ENABLED else None,
         [InlineKeyboardButton("Мой рейтинг 📊", callback_data='rating')],
         [InlineKeyboardButton("Топ игроков 🏆", callback_data='global_rating')],
         [InlineKeyboardButton("Достижения ⭐", callback_data='achievements')],
         [InlineKeyboardButton("Помощь ❓", callback_data='help')]
     ]
-    return InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup([row for row in keyboard if row])
 
 def competition_mode_keyboard():
     """Keyboard for competition time selection"""
@@ -261,10 +672,12 @@ def after_answer_keyboard(difficulty=None, competition=False):
 async def start(update: Update, context: CallbackContext) -> None:
     """Handle /start command with Russian text"""
     user = update.effective_user
+    _leave_duel_queue(user.id)
     # Store chat_id for broadcast
     try:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
+        _restore_user(cursor, user.id)
         cursor.execute('UPDATE users SET chat_id = ? WHERE user_id = ?', (update.effective_chat.id, user.id))
         conn.commit()
         conn.close()
@@ -323,9 +736,12 @@ async def reset_score(update: Update, context: CallbackContext) -> None:
         cursor.execute('DELETE FROM users WHERE user_id = ?', (user.id,))
         cursor.execute('DELETE FROM achievements WHERE user_id = ?', (user.id,))
         cursor.execute('DELETE FROM user_activity WHERE user_id = ?', (user.id,))
+        for _, cold, _ in _TIERED_TABLES:
+            cursor.execute(f'DELETE FROM {cold} WHERE user_id = ?', (user.id,))
         
         conn.commit()
         conn.close()
+        bump_leaderboard()
         
         if 'score' in context.user_data:
             context.user_data['score'] = {'correct': 0, 'total': 0, 'points': 0}
@@ -340,27 +756,23 @@ async def reset_score(update: Update, context: CallbackContext) -> None:
         logger.error(f"Error resetting score: {e}")
         await update.message.reply_text("Ошибка при сбросе прогресса. Попробуйте позже.")
 
-def generate_wrong_answers(correct_answer: int) -> list:
+def generate_wrong_answers(correct_answer: int, rng=random) -> list:
     """Generate plausible wrong answers"""
     wrong_answers = set()
     while len(wrong_answers) < 3:
         # Generate answers close to the correct one
-        variation = random.randint(-max(5, correct_answer//2), max(5, correct_answer//2))
+        variation = rng.randint(-max(5, correct_answer//2), max(5, correct_answer//2))
         if variation != 0:
             wrong_answer = correct_answer + variation
             if wrong_answer > 0 and wrong_answer != correct_answer:
                 wrong_answers.add(wrong_answer)
     return list(wrong_answers)
 
-async def create_question(update: Update, context: CallbackContext, mode: str, difficulty: str = None) -> None:
-    """Create a multiplication question"""
-    if mode == 'competition':
-        # Start competition timer
-        context.user_data['start_time'] = time.time()
-        context.user_data['mode'] = 'competition'
-        context.user_data['competition_counter'] = 0
-        difficulty = 'medium'  # Default difficulty for competition
+def generate_question(difficulty: str, rng=random) -> tuple:
+    """Generate (question_text, correct_answer, shuffled answers) for a difficulty.
     
+    Pass a seeded random.Random as rng to get a reproducible question stream.
+    """
     # Difficulty ranges
     ranges = {
         'easy': (1, 10),
@@ -371,40 +783,55 @@ async def create_question(update: Update, context: CallbackContext, mode: str, d
     a, b = ranges[difficulty]
     # Genius: always hard multiplication or division
     if difficulty == 'genius':
-        if random.random() < 0.5:
+        if rng.random() < 0.5:
             # Division: ensure integer result
-            divisor = random.randint(10, b)
-            quotient = random.randint(10, b)
+            divisor = rng.randint(10, b)
+            quotient = rng.randint(10, b)
             dividend = divisor * quotient
             correct_answer = quotient
             question_text = f"🧠 Чему равно {dividend} ÷ {divisor}?"
         else:
-            num1 = random.randint(a, b)
-            num2 = random.randint(a, b)
+            num1 = rng.randint(a, b)
+            num2 = rng.randint(a, b)
             correct_answer = num1 * num2
             question_text = f"🧠 Что такое {num1} × {num2}?"
     else:
         # For other levels, keep previous logic
-        if random.random() < 0.5:
+        if rng.random() < 0.5:
             # Division: ensure integer result
-            divisor = random.randint(max(2, a), b)
-            quotient = random.randint(a, b)
+            divisor = rng.randint(max(2, a), b)
+            quotient = rng.randint(a, b)
             dividend = divisor * quotient
             correct_answer = quotient
             question_text = f"🧮 Чему равно {dividend} ÷ {divisor}?"
         else:
-            num1 = random.randint(a, b)
-            num2 = random.randint(a, b)
+            num1 = rng.randint(a, b)
+            num2 = rng.randint(a, b)
             correct_answer = num1 * num2
             question_text = f"🧮 Что такое {num1} × {num2}?"
+    # Generate wrong answers
+    wrong_answers = generate_wrong_answers(correct_answer, rng)
+    all_answers = wrong_answers + [correct_answer]
+    rng.shuffle(all_answers)
+    return question_text, correct_answer, all_answers
+
+async def create_question(update: Update, context: CallbackContext, mode: str, difficulty: str = None) -> None:
+    """Create a multiplication question"""
+    if update.effective_user:
+        # Starting a solo game gives up a pending duel search
+        _leave_duel_queue(update.effective_user.id)
+    if mode == 'competition':
+        # Start competition timer
+        context.user_data['start_time'] = time.time()
+        context.user_data['mode'] = 'competition'
+        context.user_data['competition_counter'] = 0
+        difficulty = 'medium'  # Default difficulty for competition
+    
+    question_text, correct_answer, all_answers = generate_question(difficulty)
     # Store correct answer and start time
     context.user_data['correct_answer'] = correct_answer
     context.user_data['current_difficulty'] = difficulty
     context.user_data['question_time'] = time.time()
-    # Generate wrong answers
-    wrong_answers = generate_wrong_answers(correct_answer)
-    all_answers = wrong_answers + [correct_answer]
-    random.shuffle(all_answers)
     if mode == 'competition':
         remaining_time = context.user_data['competition_duration'] - (time.time() - context.user_data['start_time'])
         question_text = f"⏱️ {int(remaining_time)}с | {question_text}"
@@ -465,13 +892,13 @@ async def check_answer(update: Update, context: CallbackContext) -> None:
     try:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
-        cursor.execute('SELECT total_attempts FROM users WHERE user_id = ?', (user.id,))
+        cursor.execute('SELECT total_attempts, total_points FROM users WHERE user_id = ?', (user.id,))
         result = cursor.fetchone()
         conn.close()
         
-        if result and result[0] >= 5 and is_correct:
-            global_rank = get_user_rank(user.id)
-            total_users = get_total_users()
+        if result and result[0] >= RATED_ATTEMPTS and is_correct:
+            # Fresh points ranked against the snapshot, no scan of users
+            global_rank, total_users = get_rank_and_total(result[1], result[0], just_answered=True)
             message += f"\n\n🏆 Твой ранг: {global_rank}/{total_users}"
     except Exception as e:
         logger.error(f"Error showing rank: {e}")
@@ -486,44 +913,65 @@ async def check_answer(update: Update, context: CallbackContext) -> None:
     )
 
 async def next_question(update: Update, context: CallbackContext) -> None:
-    """Handle next question request"""
+    """Handle next question request, the callback is answered by button_handler"""
     query = update.callback_query
-    await query.answer()
     
     difficulty = query.data.split('_')[1]
     mode = context.user_data.get('mode', 'normal')
     
     await create_question(update, context, mode, difficulty)
 
-async def show_global_rating(update: Update, context: CallbackContext) -> None:
-    """Show global rating of top players"""
-    top_players = get_global_rating(15)
-    total_users = get_total_users()
+def render_global_rating():
+    """Build the all-time top list; returns (text, markup, None).
+
+    No board state: the global board is invalidated when a new snapshot is
+    swapped in, never per answer.
+    """
+    # Read the snapshot directly: get_global_rating hides errors behind an empty list
+    snapshot = current_snapshot()
+    top_players = list(snapshot.rows[:GLOBAL_BOARD_SIZE])
+    total_users = snapshot.total
     
     if not top_players:
-        message = "🏆 Топ игроков\n\nПока никто не играл достаточно для рейтинга! Будь первым! 🚀"
+        lines = ["🏆 Топ игроков\n\nПока никто не играл достаточно для рейтинга! Будь первым! 🚀"]
     else:
-        message = "🏆 ТОП-15 ИГРОКОВ\n\n"
-        
+        lines = [f"🏆 ТОП-{GLOBAL_BOARD_SIZE} ИГРОКОВ\n"]
+        medals = ["🥇", "🥈", "🥉"]
         for i, (user_id, username, first_name, points, correct, attempts, accuracy) in enumerate(top_players, 1):
             display_name = first_name or username or f"Игрок {user_id}"
             if i <= 3:  # Top 3 get medals
-                medals = ["🥇", "🥈", "🥉"]
-                message += f"{medals[i-1]} {i}. {display_name} - {points} очков\n"
+                lines.append(f"{medals[i-1]} {i}. {display_name} - {points} очков")
             else:
-                message += f"{i}. {display_name} - {points} очков\n"
-            
-            message += f"   ✅ {correct}/{attempts} ({accuracy:.1f}%)\n\n"
-        
-        message += f"Всего активных игроков: {total_users} 👥"
+                lines.append(f"{i}. {display_name} - {points} очков")
+            lines.append(f"   ✅ {correct}/{attempts} ({accuracy:.1f}%)\n")
+        lines.append(f"Всего активных игроков: {total_users} 👥")
     
-    await update.callback_query.edit_message_text(
-        message,
-        reply_markup=InlineKeyboardMarkup([
+    markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')],
+        [InlineKeyboardButton("📊 Мой рейтинг", callback_data='rating')]
+    ])
+    return '\n'.join(lines), markup, None
+
+async def show_global_rating(update: Update, context: CallbackContext) -> None:
+    """Show global rating of top players"""
+    try:
+        # Refresh a stale snapshot first: swapping it in is what moves the
+        # board's version, and cached_board reads the version up front
+        current_snapshot()
+        message, markup = cached_board('global', render_global_rating)
+        message += snapshot_age_note()
+    except Exception as e:
+        logger.error(f"Error getting global rating: {e}")
+        message = "Ошибка при получении рейтинга."
+        markup = InlineKeyboardMarkup([
             [InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')],
             [InlineKeyboardButton("📊 Мой рейтинг", callback_data='rating')]
         ])
-    )
+    
+    if update.callback_query:
+        await update.callback_query.edit_message_text(message, reply_markup=markup)
+    else:
+        await update.message.reply_text(message, reply_markup=markup)
 
 async def show_rating(update: Update, context: CallbackContext) -> None:
     """Show user rating with global rank"""
@@ -534,6 +982,9 @@ async def show_rating(update: Update, context: CallbackContext) -> None:
     try:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
+        # Archived players coming back see their old stats
+        if _restore_user(cursor, user_id):
+            conn.commit()
         cursor.execute('''
         SELECT total_correct, total_attempts, total_points, level 
         FROM users WHERE user_id = ?
@@ -545,8 +996,7 @@ async def show_rating(update: Update, context: CallbackContext) -> None:
         if result:
             correct, attempts, points, level = result
             accuracy = (correct / attempts * 100) if attempts > 0 else 0
-            global_rank = get_user_rank(user_id)
-            total_users = get_total_users()
+            global_rank, total_users = get_rank_and_total(points, attempts)
         else:
             correct, attempts, points, accuracy, global_rank, total_users = 0, 0, 0, 0, 0, 0
     except Exception as e:
@@ -575,6 +1025,7 @@ async def show_rating(update: Update, context: CallbackContext) -> None:
         message += "Хороший прогресс! Так держать! 👍"
     else:
         message += "Отличная работа! Ты звезда математики! 🌟"
+    message += snapshot_age_note()
     
     keyboard = [
         [InlineKeyboardButton("🏆 Топ игроков", callback_data='global_rating')],
@@ -587,47 +1038,45 @@ async def show_rating(update: Update, context: CallbackContext) -> None:
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+def render_daily_rating():
+    """Build today's top list; returns (text, markup, board state)"""
+    daily_top = get_daily_rating(DAILY_BOARD_SIZE)
+    
+    if not daily_top:
+        lines = ["📅 Сегодня еще никто не играл! Будь первым! 🚀"]
+    else:
+        lines = [f"📅 ТОП-{DAILY_BOARD_SIZE} ЗА СЕГОДНЯ\n"]
+        medals = ["🥇", "🥈", "🥉"]
+        for i, (user_id, username, first_name, points) in enumerate(daily_top, 1):
+            display_name = first_name or username or f"Игрок {user_id}"
+            if i <= 3:
+                lines.append(f"{medals[i-1]} {i}. {display_name} - {points} очков")
+            else:
+                lines.append(f"{i}. {display_name} - {points} очков")
+        lines.append('')
+    
+    markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🏆 Общий рейтинг", callback_data='global_rating')],
+        [InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]
+    ])
+    return '\n'.join(lines), markup, _board_state(daily_top, DAILY_BOARD_SIZE)
+
 async def daily_rating(update: Update, context: CallbackContext) -> None:
     """Show daily top players"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT u.user_id, u.username, u.first_name, SUM(ua.points) as daily_points
-        FROM user_activity ua
-        JOIN users u ON ua.user_id = u.user_id
-        WHERE date(ua.activity_time) = date('now')
-        GROUP BY ua.user_id 
-        ORDER BY daily_points DESC 
-        LIMIT 10
-        ''')
-        
-        daily_top = cursor.fetchall()
-        conn.close()
-        
-        if not daily_top:
-            message = "📅 Сегодня еще никто не играл! Будь первым! 🚀"
-        else:
-            message = "📅 ТОП-10 ЗА СЕГОДНЯ\n\n"
-            for i, (user_id, username, first_name, points) in enumerate(daily_top, 1):
-                display_name = first_name or username or f"Игрок {user_id}"
-                if i <= 3:
-                    medals = ["🥇", "🥈", "🥉"]
-                    message += f"{medals[i-1]} {i}. {display_name} - {points} очков\n"
-                else:
-                    message += f"{i}. {display_name} - {points} очков\n"
+        message, markup = cached_board('daily', render_daily_rating)
     except Exception as e:
         logger.error(f"Error getting daily rating: {e}")
         message = "Ошибка при получении ежедневного рейтинга."
-    
-    await update.callback_query.edit_message_text(
-        message,
-        reply_markup=InlineKeyboardMarkup([
+        markup = InlineKeyboardMarkup([
             [InlineKeyboardButton("🏆 Общий рейтинг", callback_data='global_rating')],
             [InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]
         ])
-    )
+    
+    if update.callback_query:
+        await update.callback_query.edit_message_text(message, reply_markup=markup)
+    else:
+        await update.message.reply_text(message, reply_markup=markup)
 
 async def show_achievements(update: Update, context: CallbackContext) -> None:
     """Show user achievements"""
@@ -635,6 +1084,8 @@ async def show_achievements(update: Update, context: CallbackContext) -> None:
     try:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
+        if _restore_user(cursor, user.id):
+            conn.commit()
         
         cursor.execute('SELECT achievement_id FROM achievements WHERE user_id = ?', (user.id,))
         user_achievements = [row[0] for row in cursor.fetchall()]
@@ -692,6 +1143,234 @@ async def finish_competition(update: Update, context: CallbackContext) -> None:
         ])
     )
 
+class Duel:
+    """State of one running duel; both players see the same questions"""
+    __slots__ = ('id', 'players', 'names', 'messages', 'scores', 'locked',
+                 'rng', 'difficulty', 'round', 'correct', 'started', 'timer')
+
+    def __init__(self, duel_id, players, names, messages, difficulty):
+        self.id = duel_id
+        self.players = players
+        self.names = names
+        self.messages = messages  # (chat_id, message_id) per player
+        self.scores = [0, 0]
+        self.locked = [False, False]  # answered wrong this round
+        self.rng = random.Random(random.getrandbits(64))
+        self.difficulty = difficulty
+        self.round = 0
+        self.correct = None
+        self.started = 0.0
+        self.timer = None
+
+def duel_keyboard(duel, answers):
+    """Answer buttons tagged with the duel and round so stale taps are ignored"""
+    keyboard = [
+        [InlineKeyboardButton(f"{answer}", callback_data=f'duel_answer_{duel.id}_{duel.round}_{answer}')]
+        for answer in answers
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def _leave_duel_queue(user_id):
+    level = _waiting_level.pop(user_id, None)
+    if level is not None:
+        _duel_queues[level].pop(user_id, None)
+    timer = _search_timers.pop(user_id, None)
+    if timer:
+        timer.cancel()
+
+async def _duel_search_timeout(context, user_id, chat_id, message_id):
+    await asyncio.sleep(DUEL_SEARCH_SECONDS)
+    _search_timers.pop(user_id, None)
+    _leave_duel_queue(user_id)
+    try:
+        await context.bot.edit_message_text(
+            "😔 Соперник не найден. Попробуй еще раз позже!",
+            chat_id=chat_id, message_id=message_id,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("⚔️ Искать снова", callback_data='duel')],
+                [InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]
+            ])
+        )
+    except Exception as e:
+        logger.error(f"Error ending duel search for {user_id}: {e}")
+
+async def join_duel(update: Update, context: CallbackContext) -> None:
+    """Queue the player for a duel or pair them with someone of the same level"""
+    query = update.callback_query
+    user = update.effective_user
+    
+    if not DUELS_ENABLED:
+        await query.edit_message_text("⚔️ Дуэли сейчас недоступны.", reply_markup=main_menu_keyboard())
+        return
+    if user.id in _player_duels:
+        await query.edit_message_text("⚔️ Ты уже в дуэли! Отвечай на вопросы в ней.")
+        return
+    
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        if _restore_user(cursor, user.id):
+            conn.commit()
+        cursor.execute('SELECT total_points FROM users WHERE user_id = ?', (user.id,))
+        result = cursor.fetchone()
+        conn.close()
+        level = get_user_level(result[0] if result else 0)
+    except Exception as e:
+        logger.error(f"Error getting duel level: {e}")
+        level = get_user_level(0)
+    
+    me = (user.first_name or user.username or f"Игрок {user.id}", query.message.chat_id, query.message.message_id)
+    _leave_duel_queue(user.id)
+    queue = _duel_queues.setdefault(level, {})
+    if not queue:
+        queue[user.id] = me
+        _waiting_level[user.id] = level
+        _search_timers[user.id] = asyncio.create_task(_duel_search_timeout(context, user.id, *me[1:]))
+        await query.edit_message_text(
+            f"🔎 Ищем соперника уровня {level}...",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Отмена", callback_data='duel_cancel')]
+            ])
+        )
+        return
+    
+    # Oldest waiting player of this level
+    opponent_id = next(iter(queue))
+    opponent = queue.pop(opponent_id)
+    _leave_duel_queue(opponent_id)
+    duel = Duel(
+        next(_duel_ids),
+        (opponent_id, user.id),
+        (opponent[0], me[0]),
+        (opponent[1:], me[1:]),
+        DUEL_DIFFICULTY.get(level, 'medium')
+    )
+    _duels[duel.id] = duel
+    _player_duels[opponent_id] = duel
+    _player_duels[user.id] = duel
+    await _next_duel_round(context, duel, f"⚔️ {duel.names[0]} против {duel.names[1]}!\n")
+
+async def cancel_duel_search(update: Update, context: CallbackContext) -> None:
+    """Leave the duel queue"""
+    _leave_duel_queue(update.effective_user.id)
+    await update.callback_query.edit_message_text(
+        "Выбери режим игры:",
+        reply_markup=main_menu_keyboard()
+    )
+
+async def _edit_both(context, duel, text, reply_markup=None):
+    for chat_id, message_id in duel.messages:
+        try:
+            await context.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+        except Exception as e:
+            logger.error(f"Error updating duel {duel.id}: {e}")
+
+async def _next_duel_round(context, duel, header):
+    """Send the next question to both players, or finish the duel"""
+    if duel.timer:
+        duel.timer.cancel()
+    if duel.round >= DUEL_ROUNDS:
+        await _finish_duel(context, duel, header)
+        return
+    
+    duel.round += 1
+    question_text, duel.correct, answers = generate_question(duel.difficulty, duel.rng)
+    duel.locked = [False, False]
+    duel.started = time.monotonic()
+    duel.timer = asyncio.create_task(_duel_round_timeout(context, duel, duel.round))
+    await _edit_both(
+        context, duel,
+        f"{header}\n⚔️ Раунд {duel.round}/{DUEL_ROUNDS} | Счет {duel.scores[0]}:{duel.scores[1]}\n\n{question_text}",
+        duel_keyboard(duel, answers)
+    )
+
+async def _duel_round_timeout(context, duel, round_number):
+    await asyncio.sleep(DUEL_ROUND_SECONDS)
+    if duel.round == round_number and duel.id in _duels:
+        duel.timer = None
+        await _next_duel_round(context, duel, f"⌛ Время вышло! Ответ: {duel.correct}\n")
+
+async def _finish_duel(context, duel, header):
+    del _duels[duel.id]
+    for player in duel.players:
+        _player_duels.pop(player, None)
+    
+    score_a, score_b = duel.scores
+    if score_a == score_b:
+        winner = None
+        result = "🤝 Ничья!"
+    else:
+        index = 0 if score_a > score_b else 1
+        winner = duel.players[index]
+        result = f"🏆 Победил {duel.names[index]}!"
+    _finished_duels.append((duel.players[0], duel.players[1], score_a, score_b, winner))
+    
+    await _edit_both(
+        context, duel,
+        f"{header}\n🏁 Дуэль завершена!\n{duel.names[0]} {score_a}:{score_b} {duel.names[1]}\n\n{result}",
+        InlineKeyboardMarkup([
+            [InlineKeyboardButton("⚔️ Еще дуэль", callback_data='duel')],
+            [InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]
+        ])
+    )
+
+async def duel_answer(update: Update, context: CallbackContext) -> None:
+    """Resolve a duel answer: the first correct answer wins the round"""
+    query = update.callback_query
+    user = update.effective_user
+    _, _, duel_id, round_number, answer = query.data.split('_')
+    duel = _duels.get(int(duel_id))
+    
+    if duel is None or duel.round != int(round_number) or user.id not in duel.players:
+        await query.answer("Этот раунд уже завершен")
+        return
+    index = duel.players.index(user.id)
+    if duel.locked[index]:
+        await query.answer("Ты уже ответил в этом раунде")
+        return
+    
+    # Timed on the server, from sending the question to receiving the answer.
+    # The round advances before anything is awaited so no other answer or
+    # the round timer can resolve it a second time.
+    elapsed = time.monotonic() - duel.started
+    if int(answer) == duel.correct:
+        duel.scores[index] += 1
+        await _next_duel_round(context, duel, f"✅ {duel.names[index]} первым ответил {duel.correct} за {elapsed:.1f} с\n")
+        await query.answer("✅ Верно! Раунд твой!")
+    else:
+        duel.locked[index] = True
+        if all(duel.locked):
+            await _next_duel_round(context, duel, f"❌ Оба ошиблись! Ответ: {duel.correct}\n")
+            await query.answer("❌ Неверно!")
+        else:
+            await query.answer("❌ Неверно! Ждем соперника...")
+
+def flush_duel_results():
+    """Write finished duels in one batch; returns how many were written"""
+    if not _finished_duels:
+        return 0
+    batch = _finished_duels[:]
+    del _finished_duels[:len(batch)]
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        conn.executemany('''
+        INSERT INTO duels (player1, player2, score1, score2, winner)
+        VALUES (?, ?, ?, ?, ?)
+        ''', batch)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"Error saving duel results: {e}")
+        _finished_duels[:0] = batch
+        return 0
+    return len(batch)
+
+async def duel_results_flusher(application: Application) -> None:
+    """Persist finished duels every DUEL_FLUSH_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(DUEL_FLUSH_INTERVAL)
+        flush_duel_results()
+
 async def button_handler(update: Update, context: CallbackContext) -> None:
     """Handle button callbacks"""
     query = update.callback_query
@@ -716,8 +1395,13 @@ async def button_handler(update: Update, context: CallbackContext) -> None:
         await show_achievements(update, context)
     elif query.data == 'help':
         await help_command(update, context)
+    elif query.data == 'duel':
+        await join_duel(update, context)
+    elif query.data == 'duel_cancel':
+        await cancel_duel_search(update, context)
     elif query.data == 'main_menu':
         context.user_data['mode'] = None
+        _leave_duel_queue(update.effective_user.id)
         await query.edit_message_text(
             "Выбери режим игры:",
             reply_markup=main_menu_keyboard()
@@ -750,24 +1434,213 @@ async def reset_score_button(update: Update, context: CallbackContext) -> None:
         cursor.execute('DELETE FROM users WHERE user_id = ?', (user.id,))
         cursor.execute('DELETE FROM achievements WHERE user_id = ?', (user.id,))
         cursor.execute('DELETE FROM user_activity WHERE user_id = ?', (user.id,))
+        for _, cold, _ in _TIERED_TABLES:
+            cursor.execute(f'DELETE FROM {cold} WHERE user_id = ?', (user.id,))
         conn.commit()
         conn.close()
+        bump_leaderboard()
         
         if 'score' in context.user_data:
             context.user_data['score'] = {'correct': 0, 'total': 0, 'points': 0}
         if 'achievements' in context.user_data:
             context.user_data['achievements'] = {}
         
-        await query.edit_message_text("Прогресс сброшен! 🆕\nНачинаем заново! 🚀")
-        await asyncio.sleep(2)
         await query.edit_message_text(
-            "Выбери режим игры:",
+            "Прогресс сброшен! 🆕\nНачинаем заново! 🚀\n\nВыбери режим игры:",
             reply_markup=main_menu_keyboard()
         )
     except Exception as e:
         logger.error(f"Error resetting score via button: {e}")
         await query.edit_message_text("Ошибка при сбросе прогресса.")
 
+async def watchdog_command(update: Update, context: CallbackContext) -> None:
+    """Toggle the event-loop stall watchdog and show recent stalls (admins only)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    action = context.args[0].lower() if context.args else ''
+    if action == 'on':
+        WATCHDOG.start()
+    elif action == 'off':
+        WATCHDOG.stop()
+    
+    status = "включен ✅" if WATCHDOG.enabled else "выключен ⏸️"
+    message = f"🐶 Watchdog {status}\nПорог: {WATCHDOG.threshold * 1000:.0f} мс\n"
+    stalls = list(WATCHDOG.stalls)[-3:]
+    if stalls:
+        message += f"\nПоследние блокировки ({len(WATCHDOG.stalls)} всего):\n"
+        for at, lag, stack in stalls:
+            frames = '\n'.join(stack.strip().splitlines()[-4:])
+            message += f"\n⏱️ {datetime.fromtimestamp(at):%H:%M:%S} — ≥{lag * 1000:.0f} мс\n{frames}\n"
+    else:
+        message += "\nБлокировок не было 👍"
+    await update.message.reply_text(message[:4000])
+
+async def profile_command(update: Update, context: CallbackContext) -> None:
+    """Sample the event loop for a while and send collapsed stacks (admins only)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        seconds = int(context.args[0]) if context.args else 10
+    except ValueError:
+        seconds = 10
+    seconds = min(MAX_PROFILE_SECONDS, max(1, seconds))
+    
+    if PROFILER.busy:
+        await update.message.reply_text("🔬 Профилирование уже идет, подожди.")
+        return
+    
+    await update.message.reply_text(f"🔬 Профилирую {seconds} с...")
+    stacks = await PROFILER.profile(seconds)
+    
+    summary = f"🔬 {sum(stacks.values())} сэмплов за {seconds} с\n\n"
+    for label, share in top_frames(stacks):
+        summary += f"{share * 100:.1f}% {label}\n"
+    await update.message.reply_document(
+        document=format_collapsed(stacks).encode(),
+        filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded",
+        caption=summary[:1024]
+    )
+
+async def apistats_command(update: Update, context: CallbackContext) -> None:
+    """Show Bot API calls sent and saved per handler (admins only)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    await update.message.reply_text(f"📡 Bot API\n\n{format_stats() or 'Пока нет вызовов'}"[:4000])
+
+async def daily_top_broadcast(application: Application) -> None:
+    """Send the daily top-3 to every known chat"""
+    while True:
+        await asyncio.sleep(60*60*24)  # Run once a day
+        try:
+            conn = sqlite3.connect(DB_PATH)
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id, chat_id FROM users WHERE chat_id IS NOT NULL')
+            users = cursor.fetchall()
+            top_players = get_global_rating(3)
+            if top_players:
+                msg = "🏆 Ежедневный ТОП-3 игроков:\n\n"
+                medals = ["🥇", "🥈", "🥉"]
+                for i, (user_id, username, first_name, points, correct, attempts, accuracy) in enumerate(top_players, 1):
+                    name = first_name or username or f"Игрок {user_id}"
+                    msg += f"{medals[i-1]} {name} — {points} очков\n"
+                for user_id, chat_id in users:
+                    if chat_id:
+                        try:
+                            await application.bot.send_message(chat_id, msg)
+                        except Exception as e:
+                            logger.error(f"Broadcast error: {e}")
+            conn.close()
+        except Exception as e:
+            logger.error(f"Daily broadcast error: {e}")
+
+async def monthly_prize_broadcast(application: Application) -> None:
+    """Congratulate the monthly winner"""
+    while True:
+        now = datetime.now()
+        # Run at 23:59 on last day of month
+        if now.day == 28 and now.hour == 23 and now.minute >= 59:  # For demo, use 28th
+            try:
+                conn = sqlite3.connect(DB_PATH)
+                cursor = conn.cursor()
+                cursor.execute('SELECT user_id, chat_id FROM users WHERE chat_id IS NOT NULL')
+                users = cursor.fetchall()
+                top_players = get_global_rating(1)
+                if top_players:
+                    winner = top_players[0]
+                    name = winner[2] or winner[1] or f"Игрок {winner[0]}"
+                    msg = f"🎉 Поздравляем! {name} занял первое место в месячном рейтинге и получает приз $10! Свяжитесь с админом для получения приза."
+                    chat_id = None
+                    for user_id, c_id in users:
+                        if user_id == winner[0]:
+                            chat_id = c_id
+                            break
+                    if chat_id:
+                        try:
+                            await application.bot.send_message(chat_id, msg)
+                        except Exception as e:
+                            logger.error(f"Prize error: {e}")
+                conn.close()
+            except Exception as e:
+                logger.error(f"Monthly prize error: {e}")
+        await asyncio.sleep(60)  # Check every minute
+
+async def post_init(application: Application) -> None:
+    """Start background tasks for daily and monthly notifications"""
+    BACKGROUND_TASKS.append(asyncio.create_task(daily_top_broadcast(application)))
+    BACKGROUND_TASKS.append(asyncio.create_task(monthly_prize_broadcast(application)))
+    BACKGROUND_TASKS.append(asyncio.create_task(snapshot_refresher(application)))
+    BACKGROUND_TASKS.append(asyncio.create_task(duel_results_flusher(application)))
+    if ARCHIVE_AFTER_DAYS > 0:
+        BACKGROUND_TASKS.append(asyncio.create_task(archive_task(application)))
+    if os.getenv('LOOP_WATCHDOG') == '1':
+        WATCHDOG.start()
+
+async def post_stop(application: Application) -> None:
+    """Cancel background tasks, they never finish on their own, and flush what is buffered"""
+    while BACKGROUND_TASKS:
+        BACKGROUND_TASKS.pop().cancel()
+    # Round and search timers would outlive the Application otherwise
+    while _search_timers:
+        _search_timers.popitem()[1].cancel()
+    for duel in _duels.values():
+        if duel.timer:
+            duel.timer.cancel()
+            duel.timer = None
+    flush_duel_results()
+    WATCHDOG.stop()
+    recorder = application.bot_data.pop('recorder', None)
+    if recorder:
+        recorder.close()
+
+def register_handlers(application: Application) -> None:
+    """Attach all command and callback handlers"""
+    if RECORD_UPDATES:
+        # Arrival times come from the update queue, stamped on receipt
+        recorder = UpdateRecorder(RECORD_UPDATES, arrivals=getattr(application.update_queue, 'arrivals', None))
+        application.bot_data['recorder'] = recorder
+        application.add_handler(TypeHandler(Update, recorder.handle), group=-1)
+        logger.info(f"Recording updates to {recorder.path}")
+    
+    # Add command handlers, wrapped so outbound.py can attribute Bot API calls
+    application.add_handler(CommandHandler("start", tracked(start)))
+    application.add_handler(CommandHandler("help", tracked(help_command)))
+    application.add_handler(CommandHandler("rating", tracked(show_rating)))
+    application.add_handler(CommandHandler("top", tracked(show_global_rating)))
+    application.add_handler(CommandHandler("daily", tracked(daily_rating)))
+    application.add_handler(CommandHandler("reset", tracked(reset_score)))
+    application.add_handler(CommandHandler("watchdog", tracked(watchdog_command)))
+    application.add_handler(CommandHandler("apistats", tracked(apistats_command)))
+    # Non-blocking so other updates keep flowing while the profiler samples them
+    application.add_handler(CommandHandler("profile", tracked(profile_command), block=False))
+    
+    # Add callback query handlers
+    application.add_handler(CallbackQueryHandler(tracked(button_handler), pattern='^(easy|medium|hard|competition|rating|global_rating|achievements|help|main_menu|confirm_reset|finish_competition|duel|duel_cancel)$'))
+    application.add_handler(CallbackQueryHandler(tracked(reset_score_button), pattern='^reset_score$'))
+    application.add_handler(CallbackQueryHandler(tracked(button_handler), pattern='^competition_'))
+    application.add_handler(CallbackQueryHandler(tracked(button_handler), pattern='^next_'))
+    application.add_handler(CallbackQueryHandler(tracked(check_answer), pattern='^answer_'))
+    application.add_handler(CallbackQueryHandler(tracked(duel_answer), pattern='^duel_answer_'))
+
+def build_application(updater: bool = True, request=None) -> Application:
+    """Create the Application with all handlers registered.
+    
+    Pass updater=False when updates are fed in from outside (see shard.py),
+    and a request to replace the HTTP transport (see replay.py).
+    """
+    if request is None:
+        request = HTTPXRequest(connection_pool_size=BOT_POOL_SIZE, pool_timeout=BOT_POOL_TIMEOUT)
+    outbound_bot = OutboundBot(TOKEN, request=request)
+    builder = Application.builder().bot(outbound_bot).post_init(post_init).post_stop(post_stop)
+    if not updater:
+        builder = builder.updater(None)
+    if RECORD_UPDATES:
+        builder = builder.update_queue(ArrivalQueue())
+    application = builder.build()
+    register_handlers(application)
+    return application
+
 def main() -> None:
     """Start the bot"""
     try:
@@ -775,85 +1648,12 @@ def main() -> None:
         init_database()
         
         # Create the Application
-        application = Application.builder().token(TOKEN).build()
-        
-        # Add command handlers
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("rating", show_rating))
-        application.add_handler(CommandHandler("top", show_global_rating))
-        application.add_handler(CommandHandler("daily", daily_rating))
-        application.add_handler(CommandHandler("reset", reset_score))
-        
-        # Add callback query handlers
-        application.add_handler(CallbackQueryHandler(button_handler, pattern='^(easy|medium|hard|competition|rating|global_rating|achievements|help|main_menu|confirm_reset|finish_competition)$'))
-        application.add_handler(CallbackQueryHandler(reset_score_button, pattern='^reset_score$'))
-        application.add_handler(CallbackQueryHandler(button_handler, pattern='^competition_'))
-        application.add_handler(CallbackQueryHandler(button_handler, pattern='^next_'))
-        application.add_handler(CallbackQueryHandler(check_answer, pattern='^answer_'))
+        application = build_application()
         
-        # Start background tasks for daily and monthly notifications
-        async def daily_top_broadcast():
-            while True:
-                await asyncio.sleep(60*60*24)  # Run once a day
-                try:
-                    conn = sqlite3.connect(DB_PATH)
-                    cursor = conn.cursor()
-                    cursor.execute('SELECT user_id, chat_id FROM users WHERE chat_id IS NOT NULL')
-                    users = cursor.fetchall()
-                    top_players = get_global_rating(3)
-                    if top_players:
-                        msg = "🏆 Ежедневный ТОП-3 игроков:\n\n"
-                        medals = ["🥇", "🥈", "🥉"]
-                        for i, (user_id, username, first_name, points, correct, attempts, accuracy) in enumerate(top_players, 1):
-                            name = first_name or username or f"Игрок {user_id}"
-                            msg += f"{medals[i-1]} {name} — {points} очков\n"
-                        for user_id, chat_id in users:
-                            if chat_id:
-                                try:
-                                    await application.bot.send_message(chat_id, msg)
-                                except Exception as e:
-                                    logger.error(f"Broadcast error: {e}")
-                    conn.close()
-                except Exception as e:
-                    logger.error(f"Daily broadcast error: {e}")
-        async def monthly_prize_broadcast():
-            while True:
-                now = datetime.now()
-                # Run at 23:59 on last day of month
-                if now.day == 28 and now.hour == 23 and now.minute >= 59:  # For demo, use 28th
-                    try:
-                        conn = sqlite3.connect(DB_PATH)
-                        cursor = conn.cursor()
-                        cursor.execute('SELECT user_id, chat_id FROM users WHERE chat_id IS NOT NULL')
-                        users = cursor.fetchall()
-                        top_players = get_global_rating(1)
-                        if top_players:
-                            winner = top_players[0]
-                            name = winner[2] or winner[1] or f"Игрок {winner[0]}"
-                            msg = f"🎉 Поздравляем! {name} занял первое место в месячном рейтинге и получает приз $10! Свяжитесь с админом для получения приза."
-                            chat_id = None
-                            for user_id, c_id in users:
-                                if user_id == winner[0]:
-                                    chat_id = c_id
-                                    break
-                            if chat_id:
-                                try:
-                                    await application.bot.send_message(chat_id, msg)
-                                except Exception as e:
-                                    logger.error(f"Prize error: {e}")
-                        conn.close()
-                    except Exception as e:
-                        logger.error(f"Monthly prize error: {e}")
-                await asyncio.sleep(60)  # Check every minute
         # Start the Bot
         logger.info("Bot is starting...")
         print("Bot is starting...")
         print("Press Ctrl+C to stop the bot")
-        # Start background tasks
-        loop = asyncio.get_event_loop()
-        loop.create_task(daily_top_broadcast())
-        loop.create_task(monthly_prize_broadcast())
         application.run_polling()
         
     except Exception as e:
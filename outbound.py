@@ -0,0 +1,170 @@
+"""Outbound Bot API layer.
+
+OutboundBot is the ExtBot used by the Application. On top of the regular
+bot it
+  * skips edits whose text and markup match what was last sent to that message,
+  * answers each callback query only once,
+  * coalesces edits to a message that overlap in time: while one is on the
+    wire, later ones wait behind it and only the newest is sent,
+and counts, per handler, the calls it made and the calls it saved. Handlers
+are attributed through `tracked`, which register_handlers in bot.py wraps
+around every callback.
+
+Updates are processed one at a time, so a user's sequential taps never
+overlap and each of their edits is sent. Coalescing only applies to edits
+issued concurrently, e.g. a duel round timer firing while an answer is
+being shown, or block=False handlers. There is no debounce window on
+purpose: a handler awaiting its own delayed edit would hold back every
+update queued behind it.
+"""
+import asyncio
+import collections
+import contextvars
+import functools
+import logging
+
+from telegram.error import BadRequest
+from telegram.ext import ExtBot
+
+logger = logging.getLogger(__name__)
+
+# Remembered messages and callback queries; old entries are dropped first
+MEMORY_SIZE = 10_000
+
+_current_handler = contextvars.ContextVar('current_handler', default='background')
+
+# handler name -> Counter of 'sent', 'edit_skipped', 'edit_coalesced', 'answer_deduped'
+API_STATS = collections.defaultdict(collections.Counter)
+
+def tracked(callback):
+    """Attribute Bot API calls made while `callback` runs to its name"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        token = _current_handler.set(callback.__name__)
+        try:
+            return await callback(update, context)
+        finally:
+            _current_handler.reset(token)
+    return wrapper
+
+def _count(event):
+    API_STATS[_current_handler.get()][event] += 1
+
+def _remember(memory, key, value):
+    memory[key] = value
+    memory.move_to_end(key)
+    if len(memory) > MEMORY_SIZE:
+        memory.popitem(last=False)
+
+def _digest(text, reply_markup):
+    return hash((text, reply_markup.to_json() if reply_markup is not None else None))
+
+class _EditSlot:
+    """An edit in flight for one message and the newest edit waiting behind it"""
+    __slots__ = ('parked',)
+
+    def __init__(self):
+        self.parked = None  # (arguments, future)
+
+class OutboundBot(ExtBot):
+    """ExtBot that drops redundant calls and keeps per-handler statistics"""
+    __slots__ = ('_sent_digests', '_answered', '_in_flight')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sent_digests = collections.OrderedDict()  # message key -> digest of what it shows
+        self._answered = collections.OrderedDict()  # callback query ids already answered
+        self._in_flight = {}  # message key -> _EditSlot
+
+    async def _post(self, endpoint, *args, **kwargs):
+        _count('sent')
+        return await super()._post(endpoint, *args, **kwargs)
+
+    async def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        if callback_query_id in self._answered:
+            _count('answer_deduped')
+            return True
+        result = await super().answer_callback_query(callback_query_id, *args, **kwargs)
+        # Only after it went through, so a failed answer can be retried
+        _remember(self._answered, callback_query_id, True)
+        return result
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        message = await super().send_message(chat_id, text, *args, **kwargs)
+        key = (message.chat_id, message.message_id, None)
+        _remember(self._sent_digests, key, _digest(text, kwargs.get('reply_markup')))
+        return message
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None, *args, **kwargs):
+        key = (chat_id, message_id, inline_message_id)
+        arguments = (text, chat_id, message_id, inline_message_id, args, kwargs)
+
+        slot = self._in_flight.get(key)
+        if slot is not None:
+            # Wait behind the edit on the wire; a newer edit replaces this one
+            if slot.parked is not None and not slot.parked[1].done():
+                slot.parked[1].set_result(True)
+                _count('edit_coalesced')
+            future = asyncio.get_running_loop().create_future()
+            slot.parked = (arguments, future)
+            return await future
+
+        slot = self._in_flight[key] = _EditSlot()
+        try:
+            return await self._send_edit(key, arguments)
+        finally:
+            try:
+                await self._drain(key, slot)
+            finally:
+                # Whatever happened above, the next edit must not queue behind this slot
+                del self._in_flight[key]
+                if slot.parked is not None:
+                    slot.parked[1].cancel()
+
+    async def _drain(self, key, slot):
+        """Send the newest parked edit until none is left"""
+        while slot.parked is not None:
+            (arguments, future), slot.parked = slot.parked, None
+            if future.done():
+                continue  # its caller was cancelled while waiting
+            try:
+                result = await self._send_edit(key, arguments)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    async def _send_edit(self, key, arguments):
+        text, chat_id, message_id, inline_message_id, args, kwargs = arguments
+        reply_markup = kwargs.get('reply_markup', args[2] if len(args) > 2 else None)
+        digest = _digest(text, reply_markup)
+        if self._sent_digests.get(key) == digest:
+            _count('edit_skipped')
+            return True
+
+        try:
+            result = await super().edit_message_text(text, chat_id, message_id, inline_message_id, *args, **kwargs)
+        except BadRequest as e:
+            # Telegram refuses edits that change nothing, which is what we wanted anyway
+            if 'not modified' not in str(e).lower():
+                raise
+            result = True
+        _remember(self._sent_digests, key, digest)
+        return result
+
+def format_stats():
+    """Per-handler table of calls sent and saved"""
+    lines = []
+    for handler, counter in sorted(API_STATS.items()):
+        saved = counter['edit_skipped'] + counter['edit_coalesced'] + counter['answer_deduped']
+        lines.append(
+            f"{handler}: отправлено {counter['sent']}, сэкономлено {saved} "
+            f"(правки {counter['edit_skipped']}, склеено {counter['edit_coalesced']}, "
+            f"ответы {counter['answer_deduped']})"
+        )
+    return '\n'.join(lines)
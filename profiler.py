@@ -0,0 +1,133 @@
+"""Event-loop stall watchdog and sampling profiler.
+
+Both work from a helper thread that looks at the event loop thread's
+current frame through sys._current_frames(), so nothing is instrumented
+and the cost when idle is one sleeping thread (watchdog) or nothing at
+all (profiler). They are switched on and off at runtime by admins, see
+the /watchdog and /profile commands in bot.py.
+"""
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def collapse_stack(frame):
+    """Root-first 'a;b;c' stack of a frame, the input format of flamegraph.pl"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+class LoopWatchdog:
+    """Log the stack of whatever keeps the event loop busy past a threshold.
+
+    The loop beats and the watcher looks every threshold/4, and lag counts
+    from the last beat, which can precede the block by up to threshold/4.
+    Depending on where a block falls between beats it is reported once it
+    runs past about 0.75 x threshold, always past 1.25 x threshold, and
+    never under 0.75 x threshold; the lag logged can overstate it by up
+    to threshold/4.
+    """
+
+    def __init__(self, threshold=0.2, history=20):
+        self.threshold = threshold
+        self.stalls = collections.deque(maxlen=history)
+        self._beat = 0.0
+        self._loop_thread = None
+        self._heartbeat = None
+        self._stopped = None
+
+    @property
+    def enabled(self):
+        return self._heartbeat is not None
+
+    def start(self):
+        """Start watching the running loop; call from inside the loop"""
+        if self.enabled:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped = threading.Event()
+        self._heartbeat = asyncio.get_running_loop().create_task(self._tick())
+        threading.Thread(target=self._watch, args=(self._stopped,), name='loop-watchdog', daemon=True).start()
+        logger.info(f"Loop watchdog started, threshold {self.threshold * 1000:.0f} ms")
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self._stopped.set()
+        self._heartbeat.cancel()
+        self._heartbeat = None
+        logger.info("Loop watchdog stopped")
+
+    async def _tick(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self, stopped):
+        reported = None
+        while not stopped.wait(self.threshold / 4):
+            beat = self._beat
+            lag = time.monotonic() - beat
+            if lag < self.threshold or beat == reported:
+                continue
+            # Report each stall once, with the stack as it is right now
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame))
+            self.stalls.append((time.time(), lag, stack))
+            logger.warning(f"Event loop blocked for over {lag * 1000:.0f} ms at:\n{stack}")
+
+class SamplingProfiler:
+    """Sample one thread's stack at a fixed rate and count collapsed stacks"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.busy = False
+
+    def sample(self, thread_id, duration):
+        """Blocking sampler loop; returns a Counter of collapsed stacks"""
+        stacks = collections.Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[collapse_stack(frame)] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    async def profile(self, duration):
+        """Profile the calling event loop's thread for duration seconds"""
+        if self.busy:
+            raise RuntimeError("Profiler is already running")
+        self.busy = True
+        try:
+            return await asyncio.to_thread(self.sample, threading.get_ident(), duration)
+        finally:
+            self.busy = False
+
+def format_collapsed(stacks):
+    """Text in collapsed-stack format, one 'stack count' line per stack"""
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+def top_frames(stacks, limit=5):
+    """Most frequently sampled leaf frames as (label, share) pairs"""
+    leaves = collections.Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    total = sum(leaves.values()) or 1
+    return [(label, count / total) for label, count in leaves.most_common(limit)]
@@ -0,0 +1,387 @@
+"""Record and replay of incoming update traffic.
+
+Recording is opt-in: set RECORD_UPDATES to a file path and every incoming
+update is written to a gzip-compressed JSON-lines log together with its
+arrival time. Each process starts its own file next to that path
+(updates.jsonl.gz -> updates.20261019-120000-4242.jsonl.gz), so a restart
+never appends to a log a crash left unterminated. User and chat ids are
+replaced with salted hashes and names are dropped before anything is
+written.
+
+Replaying feeds a log through the handlers from bot.py against a Bot whose
+HTTP layer is stubbed out, using a scratch database, and reports latency
+and throughput as JSON:
+
+    python replay.py run updates.*.jsonl.gz --speed 1 --out base.json
+    python replay.py run updates.*.jsonl.gz --speed max --out new.json
+    python replay.py compare base.json new.json
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import heapq
+import json
+import logging
+import os
+import secrets
+import statistics
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+# User and chat objects are recognised by shape wherever they appear (from,
+# chat, new_chat_members, left_chat_member, ...): an id plus is_bot or a chat type
+_CHAT_TYPES = {'private', 'group', 'supergroup', 'channel', 'sender'}
+_PERSONAL_KEYS = {'username', 'first_name', 'last_name', 'title', 'phone_number', 'vcard'}
+# Plain ids of users and chats, e.g. in a shared contact
+_ID_KEYS = {'user_id', 'chat_id'}
+# Opaque strings that still identify a chat
+_TOKEN_KEYS = {'chat_instance'}
+
+def _is_user_or_chat(value):
+    return 'id' in value and ('is_bot' in value or value.get('type') in _CHAT_TYPES)
+
+# Arrival times kept for updates not yet recorded; oldest dropped first
+MAX_PENDING_ARRIVALS = 10_000
+
+class ArrivalQueue(asyncio.Queue):
+    """Application update_queue that notes when each update was received.
+
+    The Updater (or shard.py) puts updates here as soon as they are fetched,
+    while handlers may only see them after a backlog; UpdateRecorder looks
+    the receipt time up by update id.
+    """
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.arrivals = {}  # update_id -> time.time() at receipt
+
+    def stamp(self, update, arrival=None):
+        """Note an update's arrival; the first stamp wins"""
+        update_id = getattr(update, 'update_id', None)
+        if update_id is None:
+            return
+        self.arrivals.setdefault(update_id, time.time() if arrival is None else arrival)
+        if len(self.arrivals) > MAX_PENDING_ARRIVALS:
+            del self.arrivals[next(iter(self.arrivals))]
+
+    def put_nowait(self, item):
+        # asyncio.Queue.put goes through here as well
+        self.stamp(item)
+        super().put_nowait(item)
+
+def session_path(path):
+    """Per-process variant of a log path, stamped with start time and pid"""
+    path = Path(path)
+    suffixes = ''.join(path.suffixes)
+    stem = path.name[:len(path.name) - len(suffixes)] if suffixes else path.name
+    session = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+    candidate, n = path.with_name(f"{stem}.{session}{suffixes}"), 1
+    while candidate.exists():
+        candidate, n = path.with_name(f"{stem}.{session}-{n}{suffixes}"), n + 1
+    return str(candidate)
+
+class UpdateRecorder:
+    """Write anonymized updates to a compressed log of this process's own"""
+
+    def __init__(self, path, salt=None, arrivals=None):
+        self.path = session_path(path)
+        self.arrivals = arrivals  # ArrivalQueue.arrivals of the Application, if any
+        self.salt = (salt or os.getenv('RECORD_SALT') or secrets.token_hex(16)).encode()
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+
+    def anonymize_id(self, value):
+        """Stable pseudonymous id, keeps the sign so group chats stay negative"""
+        digest = hashlib.blake2b(str(abs(value)).encode(), key=self.salt, digest_size=6).digest()
+        anonymous = int.from_bytes(digest, 'big') or 1
+        return -anonymous if value < 0 else anonymous
+
+    def anonymize_token(self, value):
+        """Stable pseudonym for an identifying string"""
+        return hashlib.blake2b(str(value).encode(), key=self.salt, digest_size=8).hexdigest()
+
+    def anonymize(self, data):
+        """Copy of an update dict with ids hashed and names removed"""
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        entity = _is_user_or_chat(data)
+        # Users, chats and shared contacts lose their names and numbers
+        personal = entity or 'phone_number' in data
+        result = {}
+        for key, value in data.items():
+            if personal and key in _PERSONAL_KEYS:
+                continue
+            if isinstance(value, int) and (key in _ID_KEYS or entity and key == 'id'):
+                result[key] = self.anonymize_id(value)
+            elif key in _TOKEN_KEYS and isinstance(value, str):
+                result[key] = self.anonymize_token(value)
+            else:
+                result[key] = self.anonymize(value)
+        if entity and data.get('type', 'private') == 'private':
+            result['first_name'] = f"Игрок {result['id']}"
+        return result
+
+    def record(self, update_data, arrival=None):
+        """Write one update; flushed right away so a crash loses at most one line"""
+        line = json.dumps({
+            't': time.time() if arrival is None else arrival,
+            'update': self.anonymize(update_data),
+        }, ensure_ascii=False)
+        self._file.write(line + '\n')
+        self._file.flush()
+
+    async def handle(self, update, context) -> None:
+        """TypeHandler callback, registered in a group before the real handlers"""
+        try:
+            arrival = self.arrivals.pop(update.update_id, None) if self.arrivals is not None else None
+            self.record(update.to_dict(), arrival)
+        except Exception as e:
+            logger.error(f"Error recording update: {e}")
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+def _salvage(decompressor, chunk):
+    """Output of chunk up to its first corrupt byte"""
+    data = []
+    for i in range(len(chunk)):
+        try:
+            data.append(decompressor.decompress(chunk[i:i + 1]))
+        except zlib.error:
+            break
+    return b''.join(data)
+
+def _decompress(path):
+    """Decompressed data of a gzip file, member by member, up to the first corrupt byte"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(path, 'rb') as raw:
+        for chunk in iter(lambda: raw.read(1 << 16), b''):
+            while chunk:
+                backup = decompressor.copy()
+                try:
+                    data = decompressor.decompress(chunk)
+                except zlib.error:
+                    # zlib drops the whole chunk's output; salvage it a byte at a time
+                    yield _salvage(backup, chunk)
+                    logger.warning(f"Replay log {path} is corrupt past this point, stopping there")
+                    return
+                yield data
+                if not decompressor.eof:
+                    break
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def read_log(path):
+    """Yield (arrival, update_data) for every complete record of a log.
+
+    Decompresses by hand rather than through gzip.open, which raises on a
+    crashed, unterminated file before handing out the lines it already read.
+    """
+    pending = b''
+    for data in _decompress(path):
+        *lines, pending = (pending + data).split(b'\n')
+        for line in lines:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry['t'], entry['update']
+    if pending.strip():
+        logger.warning(f"Replay log {path} ends with a partial record, stopping there")
+
+def read_logs(paths):
+    """Merge several logs (e.g. one per shard) by arrival time"""
+    return heapq.merge(*(read_log(path) for path in paths), key=lambda entry: entry[0])
+
+class StubRequest(BaseRequest):
+    """Bot API transport that answers locally and counts calls per method"""
+
+    def __init__(self):
+        self.calls = {}
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        parameters = request_data.parameters if request_data else {}
+
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'replay', 'username': 'replay_bot'}
+        elif endpoint in ('answerCallbackQuery', 'deleteMessage'):
+            result = True
+        else:
+            self._message_id += 1
+            result = {
+                'message_id': parameters.get('message_id', self._message_id),
+                'date': int(time.time()),
+                'chat': {'id': parameters.get('chat_id', 1), 'type': 'private'},
+                'text': parameters.get('text', ''),
+            }
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def _replay(entries, speed, request):
+    """Feed entries through the bot's handlers and measure each update"""
+    import bot
+    from telegram import Update
+
+    application = bot.build_application(updater=False, request=request)
+    queue = asyncio.Queue()
+    latencies = []
+    errors = 0
+
+    async def consume():
+        nonlocal errors
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            scheduled, data = item
+            try:
+                await application.process_update(Update.de_json(data, application.bot))
+            except Exception as e:
+                errors += 1
+                logger.error(f"Replay handler error: {e}")
+            latencies.append(time.perf_counter() - scheduled)
+
+    async with application:
+        consumer = asyncio.create_task(consume())
+        started = time.perf_counter()
+        first_arrival = None
+        count = 0
+        for arrival, data in entries:
+            if first_arrival is None:
+                first_arrival = arrival
+            if speed:
+                scheduled = started + (arrival - first_arrival) / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+            await queue.put((scheduled, data))
+            count += 1
+        await queue.put(None)
+        await consumer
+        duration = time.perf_counter() - started
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        'updates': count,
+        'errors': errors,
+        'duration_s': round(duration, 3),
+        'throughput_per_s': round(count / duration, 2) if duration else 0.0,
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies_ms), 3) if latencies_ms else 0.0,
+            'p50': round(_percentile(latencies_ms, 0.50), 3),
+            'p95': round(_percentile(latencies_ms, 0.95), 3),
+            'p99': round(_percentile(latencies_ms, 0.99), 3),
+            'max': round(max(latencies_ms), 3) if latencies_ms else 0.0,
+        },
+        'api_calls': dict(sorted(request.calls.items())),
+    }
+
+def run_replay(paths, speed=1.0, db_path=None):
+    """Replay logs at the given speed (0 = as fast as possible) and return a report"""
+    import bot
+
+    scratch = None
+    if db_path is None:
+        scratch = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        scratch.close()
+        db_path = scratch.name
+    bot.DB_PATH = db_path
+    bot.RECORD_UPDATES = None
+    bot.init_database()
+    try:
+        report = asyncio.run(_replay(read_logs(paths), speed, StubRequest()))
+    finally:
+        if scratch:
+            os.unlink(scratch.name)
+    report['speed'] = speed or 'max'
+    report['logs'] = list(paths)
+    return report
+
+# Metrics compared between two reports; True when higher is better
+COMPARED_METRICS = {
+    'throughput_per_s': True,
+    'latency_ms.mean': False,
+    'latency_ms.p50': False,
+    'latency_ms.p95': False,
+    'latency_ms.p99': False,
+    'latency_ms.max': False,
+}
+
+def _metric(report, name):
+    value = report
+    for part in name.split('.'):
+        value = value[part]
+    return value
+
+def compare_reports(base, new):
+    """Rows of (metric, base, new, change in percent, better?) for two reports"""
+    rows = []
+    for name, higher_is_better in COMPARED_METRICS.items():
+        old_value, new_value = _metric(base, name), _metric(new, name)
+        change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+        better = change >= 0 if higher_is_better else change <= 0
+        rows.append((name, old_value, new_value, change, better))
+    return rows
+
+def _parse_speed(value):
+    return 0.0 if value == 'max' else float(value)
+
+def main() -> None:
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:replay')
+    parser = argparse.ArgumentParser(description="Replay recorded update traffic")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="replay one or more logs against the current code")
+    run.add_argument('logs', nargs='+')
+    run.add_argument('--speed', type=_parse_speed, default=1.0, help="1, N for N times faster, or max")
+    run.add_argument('--db', help="database to replay against (default: empty scratch file)")
+    run.add_argument('--out', help="write the JSON report here instead of stdout")
+
+    compare = commands.add_parser('compare', help="show deltas between two reports")
+    compare.add_argument('base')
+    compare.add_argument('new')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        report = json.dumps(run_replay(args.logs, args.speed, args.db), indent=2)
+        if args.out:
+            with open(args.out, 'w') as out:
+                out.write(report + '\n')
+        else:
+            print(report)
+    else:
+        with open(args.base) as base, open(args.new) as new:
+            rows = compare_reports(json.load(base), json.load(new))
+        for name, old_value, new_value, change, better in rows:
+            print(f"{name:18} {old_value:>12} -> {new_value:<12} {change:+7.1f}% {'✅' if better else '❌'}")
+
+if __name__ == "__main__":
+    main()
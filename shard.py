@@ -0,0 +1,307 @@
+"""Sharded deployment of the bot.
+
+A single front process polls Telegram and routes every update to one of
+SHARDS worker processes by user id. Each worker runs the regular handlers
+from bot.py against its own SQLite file, so a user's in-memory state
+(context.user_data) and rows always live in the same worker. Updates for
+one user travel through one FIFO queue and are processed one at a time,
+which keeps their order intact.
+
+Workers periodically publish a compact leaderboard summary (top rows,
+daily top and a points histogram) that the front relays to all other
+workers, so global rating, rank and player counts cover every shard.
+Duel matchmaking is per process and is switched off with more than one
+worker.
+
+Each worker owns the rows of its users in its own file (game.db ->
+game.shard0.db, ...). On the first sharded start an existing single-file
+database is split into those files automatically; it can also be done by
+hand. The split depends on SHARDS, so SHARDS cannot change while shard
+files exist: stop the bot, merge them back and start with the new value.
+
+    python shard.py            # run, splitting DB_PATH on first start
+    python shard.py split      # partition DB_PATH into per-shard files
+    python shard.py merge      # fold the shard files back into DB_PATH
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from telegram import Bot, Update
+
+import bot
+from replay import ArrivalQueue
+
+logger = logging.getLogger(__name__)
+
+SHARDS = int(os.getenv('SHARDS', str(os.cpu_count() or 2)))
+EXCHANGE_INTERVAL = float(os.getenv('SHARD_EXCHANGE_INTERVAL', '30'))
+
+# Tables partitioned between shards and the column naming the owning user
+SHARDED_TABLES = [
+    ('users', 'user_id'),
+    ('achievements', 'user_id'),
+    ('user_activity', 'user_id'),
+    ('users_cold', 'user_id'),
+    ('achievements_cold', 'user_id'),
+    ('user_activity_cold', 'user_id'),
+    ('duels', 'player1'),
+]
+
+def shard_for(user_id, shards):
+    """Pick the worker that owns a user; updates without a user go to shard 0"""
+    if not user_id:
+        return 0
+    return abs(user_id) % shards
+
+def shard_path(index, path):
+    """Per-worker variant of a file path, e.g. game.db -> game.shard0.db"""
+    path = Path(path)
+    suffixes = ''.join(path.suffixes)
+    stem = path.name[:len(path.name) - len(suffixes)] if suffixes else path.name
+    return str(path.with_name(f"{stem}.shard{index}{suffixes}"))
+
+def route(update, inboxes):
+    """Queue an update for the worker owning its user"""
+    user = update.effective_user
+    index = shard_for(user.id if user else None, len(inboxes))
+    # Stamped here, on receipt, so recorded arrival times don't include queueing in the worker
+    inboxes[index].put(('update', (update.to_dict(), time.time())))
+    return index
+
+def _columns(conn, table, skip=()):
+    return ', '.join(row[1] for row in conn.execute(f'PRAGMA main.table_info({table})') if row[1] not in skip)
+
+def check_layout(db_path, index, shards):
+    """Stamp a shard file with its place in the split, or refuse a different one"""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS shard_layout (shard INTEGER, shards INTEGER)')
+        layout = conn.execute('SELECT shard, shards FROM shard_layout').fetchone()
+        if layout is None:
+            conn.execute('INSERT INTO shard_layout (shard, shards) VALUES (?, ?)', (index, shards))
+            conn.commit()
+        elif layout != (index, shards):
+            raise RuntimeError(
+                f"{db_path} is shard {layout[0]} of {layout[1]}, not {index} of {shards}; "
+                f"run 'python shard.py merge' before changing SHARDS"
+            )
+    finally:
+        conn.close()
+
+def split_database(shards, db_path=None):
+    """Partition a single-file database into per-shard files by shard_for"""
+    source = db_path or bot.DB_PATH
+    targets = [shard_path(index, source) for index in range(shards)]
+    existing = [target for target in targets if os.path.exists(target)]
+    if existing:
+        raise FileExistsError(f"Shard files already exist: {', '.join(existing)}")
+
+    # Bring an older database up to the current schema first
+    bot.init_database(source)
+    for index, target in enumerate(targets):
+        bot.init_database(target)
+        conn = sqlite3.connect(target)
+        try:
+            conn.execute('ATTACH DATABASE ? AS source', (source,))
+            for table, owner in SHARDED_TABLES:
+                columns = _columns(conn, table)
+                # Same rule as shard_for: abs(user_id) % shards, no user -> shard 0
+                conn.execute(
+                    f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM source.{table} '
+                    f'WHERE abs(coalesce({owner}, 0)) % ? = ?',
+                    (shards, index)
+                )
+            conn.commit()
+            conn.execute('DETACH DATABASE source')
+        finally:
+            conn.close()
+        check_layout(target, index, shards)
+    logger.info(f"Split {source} into {shards} shards")
+    return targets
+
+def merge_databases(db_path=None):
+    """Fold per-shard files back into one database and remove them"""
+    target = db_path or bot.DB_PATH
+    first = shard_path(0, target)
+    if not os.path.exists(first):
+        raise FileNotFoundError(f"No shard files next to {target}")
+    if os.path.exists(target):
+        raise FileExistsError(f"{target} already exists, move it away before merging")
+
+    conn = sqlite3.connect(first)
+    try:
+        shards = conn.execute('SELECT shards FROM shard_layout').fetchone()[0]
+    finally:
+        conn.close()
+
+    sources = [shard_path(index, target) for index in range(shards)]
+    bot.init_database(target)
+    conn = sqlite3.connect(target)
+    try:
+        for source in sources:
+            conn.execute('ATTACH DATABASE ? AS source', (source,))
+            for table, _ in SHARDED_TABLES:
+                # Autoincrement ids restart in every shard, let the merged file renumber them
+                columns = _columns(conn, table, skip=('id',))
+                conn.execute(f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM source.{table}')
+            conn.commit()
+            conn.execute('DETACH DATABASE source')
+    finally:
+        conn.close()
+    for source in sources:
+        os.remove(source)
+    logger.info(f"Merged {shards} shards into {target}")
+    return target
+
+def prepare_databases(shards):
+    """Split DB_PATH on the first sharded start and check the existing split"""
+    targets = [shard_path(index, bot.DB_PATH) for index in range(shards)]
+    if os.path.exists(bot.DB_PATH) and not any(os.path.exists(target) for target in targets):
+        split_database(shards)
+    for index, target in enumerate(targets):
+        if os.path.exists(target):
+            check_layout(target, index, shards)
+
+async def _publish_board(index, outbox):
+    """Periodically send this shard's leaderboard summary to the front"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            board = await loop.run_in_executor(None, bot.get_local_board)
+            outbox.put(('board', index, board))
+        except Exception as e:
+            logger.error(f"Shard {index} board exchange error: {e}")
+        await asyncio.sleep(EXCHANGE_INTERVAL)
+
+async def _serve(index, inbox, outbox, application):
+    """Feed updates from the front into the worker's Application"""
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.start()
+        await bot.post_init(application)
+        exchange = asyncio.create_task(_publish_board(index, outbox))
+
+        while True:
+            message = await loop.run_in_executor(None, inbox.get)
+            if message is None:
+                break
+            kind, payload = message
+            if kind == 'update':
+                data, arrival = payload
+                update = Update.de_json(data, application.bot)
+                if isinstance(application.update_queue, ArrivalQueue):
+                    application.update_queue.stamp(update, arrival)
+                # The Application fetches from update_queue one update at a
+                # time, so per-user order is preserved
+                await application.update_queue.put(update)
+            elif kind == 'board':
+                bot.set_peer_board(*payload)
+
+        exchange.cancel()
+        await bot.post_stop(application)
+        await application.stop()
+
+def run_worker(index, shards, inbox, outbox, build_application=None):
+    """Worker process entry point"""
+    # Ctrl+C is handled by the front, which drains the workers in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    bot.DB_PATH = shard_path(index, bot.DB_PATH)
+    if bot.RECORD_UPDATES:
+        # One log per worker, replay.py merges them back by arrival time
+        bot.RECORD_UPDATES = shard_path(index, bot.RECORD_UPDATES)
+    if shards > 1:
+        # Every worker would have its own duel queue and players on different
+        # shards would wait for each other forever
+        bot.DUELS_ENABLED = False
+    bot.init_database()
+    check_layout(bot.DB_PATH, index, shards)
+    application = (build_application or bot.build_application)(updater=False)
+    logger.info(f"Shard {index} serving database {bot.DB_PATH}")
+    asyncio.run(_serve(index, inbox, outbox, application))
+
+def _relay_boards(outbox, inboxes):
+    """Forward every shard's leaderboard summary to all other shards"""
+    while True:
+        message = outbox.get()
+        if message is None:
+            break
+        _, index, board = message
+        for i, inbox in enumerate(inboxes):
+            if i != index:
+                inbox.put(('board', (index, board)))
+
+async def _poll(inboxes):
+    """Long-poll Telegram and route updates to the workers"""
+    offset = None
+    async with Bot(bot.TOKEN) as telegram_bot:
+        while True:
+            try:
+                updates = await telegram_bot.get_updates(
+                    offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES
+                )
+            except Exception as e:
+                logger.error(f"Polling error: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                route(update, inboxes)
+                offset = update.update_id + 1
+
+def start_workers(shards, build_application=None):
+    """Spawn worker processes; returns (workers, inboxes, outbox)"""
+    ctx = multiprocessing.get_context('spawn')
+    inboxes = [ctx.Queue() for _ in range(shards)]
+    outbox = ctx.Queue()
+    workers = [
+        ctx.Process(target=run_worker, args=(i, shards, inboxes[i], outbox, build_application), name=f"shard-{i}")
+        for i in range(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    threading.Thread(target=_relay_boards, args=(outbox, inboxes), daemon=True).start()
+    return workers, inboxes, outbox
+
+def stop_workers(workers, inboxes, outbox):
+    """Drain and stop worker processes"""
+    for inbox in inboxes:
+        inbox.put(None)
+    for worker in workers:
+        worker.join()
+    outbox.put(None)
+
+def serve() -> None:
+    """Start the front process and its workers"""
+    prepare_databases(SHARDS)
+    workers, inboxes, outbox = start_workers(SHARDS)
+    logger.info(f"Bot is starting with {SHARDS} shards...")
+    print(f"Bot is starting with {SHARDS} shards...")
+    print("Press Ctrl+C to stop the bot")
+    try:
+        asyncio.run(_poll(inboxes))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(workers, inboxes, outbox)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the bot sharded by user id")
+    parser.add_argument('command', nargs='?', choices=['run', 'split', 'merge'], default='run')
+    args = parser.parse_args()
+    if args.command == 'split':
+        for target in split_database(SHARDS):
+            print(target)
+    elif args.command == 'merge':
+        print(merge_databases())
+    else:
+        serve()
+
+if __name__ == "__main__":
+    main()
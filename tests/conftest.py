@@ -0,0 +1,52 @@
+import itertools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:test')
+
+import bot
+from telegram import Update
+
+_update_ids = itertools.count(1)
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Fresh database for bot.py, with its in-memory leaderboard and duel state reset"""
+    path = str(tmp_path / 'game.db')
+    monkeypatch.setattr(bot, 'DB_PATH', path)
+    monkeypatch.setattr(bot, 'RECORD_UPDATES', None)
+    monkeypatch.setattr(bot, 'PEER_BOARDS', {})
+    monkeypatch.setattr(bot, '_snapshot', None)
+    monkeypatch.setattr(bot, '_snapshot_local', None)
+    monkeypatch.setattr(bot, '_RENDER_CACHE', {})
+    monkeypatch.setattr(bot, 'LEADERBOARD_VERSION', {'global': 0, 'daily': 0})
+    monkeypatch.setattr(bot, '_duel_queues', {})
+    monkeypatch.setattr(bot, '_waiting_level', {})
+    monkeypatch.setattr(bot, '_search_timers', {})
+    monkeypatch.setattr(bot, '_duels', {})
+    monkeypatch.setattr(bot, '_player_duels', {})
+    monkeypatch.setattr(bot, '_finished_duels', [])
+    bot.init_database()
+    return path
+
+def make_callback_update(user_id, data, telegram_bot=None, update_id=None):
+    """Callback query update from a private chat, as Telegram would send it"""
+    if update_id is None:
+        update_id = next(_update_ids)
+    return Update.de_json({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': 'test',
+            'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"u{user_id}"},
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': 'menu'},
+        },
+    }, telegram_bot)
+
+@pytest.fixture
+def callback_update():
+    return make_callback_update
@@ -0,0 +1,47 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+class _Query:
+    def __init__(self):
+        self.texts = []
+
+    async def edit_message_text(self, text, *args, **kwargs):
+        self.texts.append(text)
+
+@pytest.fixture
+def archived_user(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+    INSERT INTO users (user_id, first_name, total_correct, total_attempts, total_points, level, last_activity)
+    VALUES (7, 'Old', 40, 50, 1234, '🥈 Серебро', datetime('now', '-200 days'))
+    ''')
+    conn.execute("INSERT INTO achievements (user_id, achievement_id) VALUES (7, 'first_5')")
+    conn.commit()
+    conn.close()
+    assert bot.archive_inactive_users(days=90) == 1
+    return db_path
+
+def _hot_points(db_path, user_id):
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute('SELECT total_points FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+@pytest.mark.parametrize('handler, expected', [
+    (bot.show_rating, '⭐ Очки: 1234'),
+    (bot.show_achievements, '🎯 Получено: 1/'),
+])
+def test_read_paths_restore_archived_user(archived_user, handler, expected):
+    assert _hot_points(archived_user, 7) is None
+    query = _Query()
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=7), callback_query=query)
+    asyncio.run(handler(update, SimpleNamespace(user_data={})))
+    assert expected in query.texts[-1]
+    assert _hot_points(archived_user, 7) == 1234
@@ -0,0 +1,143 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import bot
+from replay import StubRequest
+
+@pytest.fixture
+def play(db_path, callback_update):
+    """Run a scenario against a live Application; it gets tap(user_id, data)"""
+    application = bot.build_application(updater=False, request=StubRequest())
+
+    def run(scenario):
+        async def main():
+            async with application:
+                async def tap(user_id, data):
+                    await application.process_update(callback_update(user_id, data, application.bot))
+                await scenario(tap)
+        asyncio.run(main())
+    run.application = application
+    return run
+
+async def _start_duel(tap):
+    """Pair players 1 and 2; player 1 queued first and is players[0]"""
+    await tap(1, 'duel')
+    await tap(2, 'duel')
+    return bot._player_duels[1]
+
+def _answer(duel, value):
+    return f"duel_answer_{duel.id}_{duel.round}_{value}"
+
+def test_first_correct_answer_wins_the_round(play):
+    async def scenario(tap):
+        duel = await _start_duel(tap)
+        first_round = _answer(duel, duel.correct)
+        await tap(2, first_round)
+        assert duel.scores == [0, 1] and duel.round == 2
+        # The slower correct answer arrives for a round that is already over
+        await tap(1, first_round)
+        assert duel.scores == [0, 1] and duel.round == 2
+
+    play(scenario)
+
+def test_wrong_answer_locks_the_player_out_of_the_round(play):
+    async def scenario(tap):
+        duel = await _start_duel(tap)
+        await tap(1, _answer(duel, duel.correct + 1))
+        assert duel.locked == [True, False]
+        await tap(1, _answer(duel, duel.correct))
+        assert duel.scores == [0, 0] and duel.round == 1
+        await tap(2, _answer(duel, duel.correct))
+        assert duel.scores == [0, 1] and duel.round == 2
+
+    play(scenario)
+
+def test_both_wrong_moves_on_without_a_point(play):
+    async def scenario(tap):
+        duel = await _start_duel(tap)
+        await tap(1, _answer(duel, duel.correct + 1))
+        await tap(2, _answer(duel, duel.correct + 1))
+        assert duel.scores == [0, 0] and duel.round == 2 and duel.locked == [False, False]
+
+    play(scenario)
+
+def test_unanswered_rounds_time_out_into_a_draw(play, monkeypatch):
+    monkeypatch.setattr(bot, 'DUEL_ROUND_SECONDS', 0.01)
+
+    async def scenario(tap):
+        await _start_duel(tap)
+        for _ in range(100):
+            if bot._finished_duels:
+                break
+            await asyncio.sleep(0.01)
+        assert bot._finished_duels == [(1, 2, 0, 0, None)]
+        assert bot._duels == {} and bot._player_duels == {}
+
+    play(scenario)
+
+def test_finished_duel_is_written_in_a_batch(play, db_path):
+    async def scenario(tap):
+        duel = await _start_duel(tap)
+        for _ in range(bot.DUEL_ROUNDS):
+            await tap(1, _answer(duel, duel.correct))
+        assert bot._finished_duels == [(1, 2, bot.DUEL_ROUNDS, 0, 1)]
+        # Taps on the finished duel's buttons change nothing
+        await tap(2, _answer(duel, duel.correct))
+        assert bot.flush_duel_results() == 1
+
+    play(scenario)
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT player1, player2, score1, score2, winner FROM duels').fetchall() == [
+        (1, 2, bot.DUEL_ROUNDS, 0, 1)
+    ]
+    conn.close()
+
+def test_solo_game_leaves_duel_queue(play):
+    async def scenario(tap):
+        await tap(1, 'duel')
+        assert 1 in bot._waiting_level
+        await tap(1, 'easy')
+        assert 1 not in bot._waiting_level
+        # The next player waits instead of being paired with someone who left
+        await tap(2, 'duel')
+        assert 2 not in bot._player_duels
+
+    play(scenario)
+
+def test_post_stop_cancels_round_timers(play):
+    async def scenario(tap):
+        duel = await _start_duel(tap)
+        timer = duel.timer
+        assert timer is not None and not timer.done()
+        await bot.post_stop(play.application)
+        await asyncio.sleep(0)
+        assert timer.cancelled()
+        assert duel.timer is None
+
+    play(scenario)
+
+def test_search_gives_up_without_opponent(play, monkeypatch):
+    monkeypatch.setattr(bot, 'DUEL_SEARCH_SECONDS', 0.01)
+
+    async def scenario(tap):
+        await tap(1, 'duel')
+        assert 1 in bot._waiting_level
+        await asyncio.sleep(0.05)
+        assert 1 not in bot._waiting_level
+        assert bot._search_timers == {}
+
+    play(scenario)
+
+def test_duels_can_be_switched_off(play, monkeypatch):
+    monkeypatch.setattr(bot, 'DUELS_ENABLED', False)
+    callbacks = [button.callback_data for row in bot.main_menu_keyboard().inline_keyboard for button in row]
+    assert 'duel' not in callbacks
+
+    async def scenario(tap):
+        await tap(1, 'duel')
+        await tap(2, 'duel')
+        assert bot._waiting_level == {} and bot._player_duels == {}
+
+    play(scenario)
@@ -0,0 +1,110 @@
+import sqlite3
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def database(db_path):
+    """Five rated players with 10 to 50 points"""
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        'INSERT INTO users (user_id, first_name, total_correct, total_attempts, total_points) VALUES (?, ?, ?, ?, ?)',
+        [(user_id, f"u{user_id}", 5, 10, user_id * 10) for user_id in range(1, 6)]
+    )
+    conn.commit()
+    conn.close()
+    return db_path
+
+def test_failed_render_is_not_cached(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'DB_PATH', str(tmp_path / 'missing' / 'game.db'))
+    with pytest.raises(sqlite3.Error):
+        bot.cached_board('global', bot.render_global_rating)
+    assert 'global' not in bot._RENDER_CACHE
+
+    monkeypatch.setattr(bot, 'DB_PATH', database)
+    text, _ = bot.cached_board('global', bot.render_global_rating)
+    assert 'u5 - 50' in text
+    assert 'global' in bot._RENDER_CACHE
+
+def test_failed_rebuild_keeps_last_snapshot(database, tmp_path, monkeypatch):
+    built = bot.current_snapshot()
+    monkeypatch.setattr(bot, 'SNAPSHOT_MAX_AGE', 0)
+    monkeypatch.setattr(bot, 'DB_PATH', str(tmp_path / 'missing' / 'game.db'))
+    assert bot.current_snapshot() is built
+    assert bot.get_total_users() == 5
+    assert 'Обновлено' in bot.snapshot_age_note()
+
+def test_age_note_without_snapshot(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'DB_PATH', str(tmp_path / 'missing' / 'game.db'))
+    assert bot.snapshot_age_note() == ""
+
+def test_rank_never_exceeds_total_for_new_players(database):
+    bot.current_snapshot()
+    # The answer that takes a player to RATED_ATTEMPTS, with the fewest points
+    assert bot.get_rank_and_total(1, bot.RATED_ATTEMPTS, just_answered=True) == (6, 6)
+    # Same player, ranked before the snapshot caught up with them
+    assert bot.get_rank_and_total(1, bot.RATED_ATTEMPTS + 2) == (6, 6)
+    # A player already in the snapshot is not counted twice
+    assert bot.get_rank_and_total(50, 10, just_answered=True) == (1, 5)
+
+def test_stale_snapshot_is_rebuilt_before_the_cached_board_is_used(database, monkeypatch):
+    import asyncio
+    from types import SimpleNamespace
+
+    texts = []
+
+    async def edit_message_text(text, **kwargs):
+        texts.append(text)
+
+    update = SimpleNamespace(callback_query=SimpleNamespace(edit_message_text=edit_message_text))
+    bot.current_snapshot()
+    asyncio.run(bot.show_global_rating(update, None))
+    assert 'u5 - 50 очков' in texts[-1]
+    assert 'global' in bot._RENDER_CACHE
+
+    conn = sqlite3.connect(database)
+    conn.execute('UPDATE users SET total_points = 70 WHERE user_id = 5')
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(bot, 'SNAPSHOT_MAX_AGE', 0)
+    asyncio.run(bot.show_global_rating(update, None))
+    assert 'u5 - 70 очков' in texts[-1]
+
+@pytest.fixture
+def daily_board(database, monkeypatch):
+    """Today's board of size 3 rendered and cached: 50, 40, 30 points"""
+    monkeypatch.setattr(bot, 'DAILY_BOARD_SIZE', 3)
+    conn = sqlite3.connect(database)
+    conn.executemany('INSERT INTO user_activity (user_id, points) VALUES (?, ?)',
+                     [(user_id, user_id * 10) for user_id in range(1, 6)])
+    conn.commit()
+    conn.close()
+    bot.cached_board('daily', bot.render_daily_rating)
+    return bot.LEADERBOARD_VERSION['daily']
+
+def _answer(user_id, correct=True, points=5):
+    bot.update_user_stats(user_id, None, f"u{user_id}", None, correct=correct, points=points)
+
+def test_answer_below_cutoff_keeps_daily_board(daily_board):
+    _answer(1, points=5)  # 15 points, cutoff is 30
+    _answer(4, correct=False, points=0)
+    assert bot.LEADERBOARD_VERSION['daily'] == daily_board
+
+def test_answer_reaching_cutoff_bumps_daily_board(daily_board):
+    _answer(2, points=10)  # 30 points, ties the cutoff
+    assert bot.LEADERBOARD_VERSION['daily'] == daily_board + 1
+    text, _ = bot.cached_board('daily', bot.render_daily_rating)
+    assert 'u2 - 30' in text
+
+def test_answer_by_board_member_bumps_daily_board(daily_board):
+    _answer(5, points=1)
+    assert bot.LEADERBOARD_VERSION['daily'] == daily_board + 1
+
+def test_any_answer_bumps_a_board_with_free_places(daily_board, monkeypatch):
+    monkeypatch.setattr(bot, 'DAILY_BOARD_SIZE', 10)
+    monkeypatch.setattr(bot, '_RENDER_CACHE', {})
+    bot.cached_board('daily', bot.render_daily_rating)
+    version = bot.LEADERBOARD_VERSION['daily']
+    _answer(1, points=1)
+    assert bot.LEADERBOARD_VERSION['daily'] == version + 1
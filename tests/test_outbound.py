@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from telegram.error import NetworkError
+
+from outbound import OutboundBot
+from replay import StubRequest
+
+class FlakyRequest(StubRequest):
+    """StubRequest whose first answerCallbackQuery fails"""
+
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        if url.endswith('answerCallbackQuery') and not self.failed:
+            self.failed = True
+            raise NetworkError("connection reset")
+        return await super().do_request(url, method, request_data, *args, **kwargs)
+
+class GatedRequest(StubRequest):
+    """StubRequest that holds every edit until the gate opens and logs its text"""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = asyncio.Event()
+        self.edits = []
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        if url.endswith('editMessageText'):
+            await self.gate.wait()
+            self.edits.append(request_data.parameters['text'])
+        return await super().do_request(url, method, request_data, *args, **kwargs)
+
+def _edit(bot, text):
+    return asyncio.ensure_future(bot.edit_message_text(text, chat_id=1, message_id=1))
+
+def test_failed_answer_can_be_retried():
+    request = FlakyRequest()
+
+    async def answer_three_times():
+        async with OutboundBot('0:test', request=request) as bot:
+            with pytest.raises(NetworkError):
+                await bot.answer_callback_query('42')
+            assert await bot.answer_callback_query('42')
+            assert await bot.answer_callback_query('42')
+
+    asyncio.run(answer_three_times())
+    assert request.calls.get('answerCallbackQuery') == 1
+
+def test_identical_edit_is_skipped():
+    request = GatedRequest()
+    request.gate.set()
+
+    async def edit_twice():
+        async with OutboundBot('0:test', request=request) as bot:
+            await _edit(bot, 'same')
+            assert await _edit(bot, 'same') is True
+
+    asyncio.run(edit_twice())
+    assert request.edits == ['same']
+
+def test_overlapping_edits_send_only_the_newest():
+    request = GatedRequest()
+
+    async def overlap():
+        async with OutboundBot('0:test', request=request) as bot:
+            first = _edit(bot, 'one')
+            await asyncio.sleep(0.01)
+            second, third = _edit(bot, 'two'), _edit(bot, 'three')
+            await asyncio.sleep(0.01)
+            assert second.done() and second.result() is True
+            request.gate.set()
+            await asyncio.gather(first, third)
+
+    asyncio.run(overlap())
+    assert request.edits == ['one', 'three']
+
+def test_cancelled_waiting_edit_does_not_block_the_message():
+    request = GatedRequest()
+
+    async def cancel_waiter():
+        async with OutboundBot('0:test', request=request) as bot:
+            first = _edit(bot, 'one')
+            await asyncio.sleep(0.01)
+            second = _edit(bot, 'two')
+            await asyncio.sleep(0.01)
+            second.cancel()
+            request.gate.set()
+            await first
+            await asyncio.wait_for(_edit(bot, 'three'), timeout=1)
+
+    asyncio.run(cancel_waiter())
+    assert request.edits == ['one', 'three']
@@ -0,0 +1,68 @@
+import asyncio
+import collections
+import time
+
+import pytest
+
+from profiler import LoopWatchdog, SamplingProfiler, collapse_stack, format_collapsed, top_frames
+
+def _block_loop(seconds):
+    """Hold the event loop thread without yielding"""
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+def _watch(threshold, block):
+    watchdog = LoopWatchdog(threshold=threshold)
+
+    async def scenario():
+        watchdog.start()
+        await asyncio.sleep(threshold)
+        _block_loop(block)
+        await asyncio.sleep(threshold)
+        watchdog.stop()
+
+    asyncio.run(scenario())
+    return watchdog
+
+def test_watchdog_records_a_blocked_loop():
+    watchdog = _watch(threshold=0.05, block=0.2)
+    assert len(watchdog.stalls) == 1
+    _, lag, stack = watchdog.stalls[0]
+    assert lag >= 0.05
+    assert '_block_loop' in stack
+
+def test_watchdog_ignores_blocks_under_three_quarters_of_the_threshold():
+    watchdog = _watch(threshold=0.2, block=0.1)
+    assert not watchdog.stalls
+    assert not watchdog.enabled
+
+def test_profiler_samples_the_loop_thread():
+    profiler = SamplingProfiler(interval=0.001)
+
+    async def scenario():
+        task = asyncio.create_task(profiler.profile(0.15))
+        await asyncio.sleep(0.02)
+        with pytest.raises(RuntimeError):
+            await profiler.profile(0.01)
+        _block_loop(0.1)
+        return await task
+
+    stacks = asyncio.run(scenario())
+    assert not profiler.busy
+    # The sampler competes with the busy loop for the GIL, so only presence is certain
+    assert any(stack.rsplit(';', 1)[-1].startswith('_block_loop (') for stack in stacks)
+
+def test_collapsed_output():
+    stacks = collections.Counter({'main;handler;query': 3, 'main;handler': 1, 'main;idle': 4})
+    assert format_collapsed(stacks) == 'main;idle 4\nmain;handler;query 3\nmain;handler 1\n'
+    assert top_frames(stacks, limit=2) == [('idle', 0.5), ('query', 0.375)]
+
+def test_collapse_stack_is_root_first():
+    def inner():
+        import sys
+        return collapse_stack(sys._getframe())
+
+    labels = inner().split(';')
+    assert labels[-1].startswith('inner (test_profiler.py:')
+    assert labels[-2].startswith('test_collapse_stack_is_root_first (')
@@ -0,0 +1,116 @@
+import asyncio
+import gzip
+import time
+
+from telegram import Update
+
+from replay import ArrivalQueue, UpdateRecorder, read_log, read_logs
+
+def _message_update(update_id, user_id=42):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Name', 'username': 'name'},
+            'text': '/start',
+        },
+    }, None)
+
+def test_recorderlogs_arrival_not_processing_time(tmp_path):
+    queue = ArrivalQueue()
+    recorder = UpdateRecorder(str(tmp_path / 'updates.jsonl.gz'), salt='test', arrivals=queue.arrivals)
+
+    async def receive_then_handle():
+        queue.stamp(_message_update(1), arrival=100.0)  # stamped upstream, e.g. by shard.route
+        await queue.put(_message_update(1))
+        await queue.put(_message_update(2))
+        received = time.time()
+        for _ in range(2):
+            await asyncio.sleep(0.01)
+            await recorder.handle(await queue.get(), None)
+        return received
+
+    received = asyncio.run(receive_then_handle())
+    recorder.close()
+
+    (first, data), (second, _) = read_log(recorder.path)
+    assert first == 100.0
+    assert second <= received
+    assert queue.arrivals == {}
+    assert data['message']['from']['id'] != 42
+    assert 'username' not in data['message']['from']
+
+def test_log_written_before_a_crash_stays_readable(tmp_path):
+    base = str(tmp_path / 'updates.jsonl.gz')
+    crashed = UpdateRecorder(base, salt='test')
+    crashed.record(_message_update(1).to_dict(), arrival=1.0)
+    crashed.record(_message_update(2).to_dict(), arrival=2.0)
+    # What a killed process leaves behind: flushed records, no gzip trailer
+    with open(crashed.path, 'rb') as log:
+        unterminated = log.read()
+
+    restarted = UpdateRecorder(base, salt='test')
+    assert restarted.path != crashed.path
+    restarted.record(_message_update(3).to_dict(), arrival=3.0)
+    restarted.close()
+
+    with open(crashed.path, 'wb') as log:
+        log.write(unterminated)
+    assert [arrival for arrival, _ in read_log(crashed.path)] == [1.0, 2.0]
+    assert [arrival for arrival, _ in read_logs([crashed.path, restarted.path])] == [1.0, 2.0, 3.0]
+
+    # Logs from before one file per process: a new member after the unterminated one
+    appended = tmp_path / 'appended.jsonl.gz'
+    with open(restarted.path, 'rb') as log:
+        appended.write_bytes(unterminated + log.read())
+    assert [arrival for arrival, _ in read_log(str(appended))] == [1.0, 2.0]
+
+def test_members_of_a_complete_log_are_all_read(tmp_path):
+    path = tmp_path / 'two.jsonl.gz'
+    for arrival in (1.0, 2.0):
+        with gzip.open(path, 'at', encoding='utf-8') as log:
+            log.write(f'{{"t": {arrival}, "update": {{}}}}\n')
+    assert [arrival for arrival, _ in read_log(str(path))] == [1.0, 2.0]
+
+def test_post_stop_closes_the_recorder(tmp_path, monkeypatch):
+    import bot
+    from replay import StubRequest
+
+    monkeypatch.setattr(bot, 'RECORD_UPDATES', str(tmp_path / 'updates.jsonl.gz'))
+    application = bot.build_application(updater=False, request=StubRequest())
+    recorder = application.bot_data['recorder']
+    recorder.record(_message_update(1).to_dict(), arrival=1.0)
+    asyncio.run(bot.post_stop(application))
+
+    with gzip.open(recorder.path, 'rt', encoding='utf-8') as log:
+        assert len(log.readlines()) == 1
+
+def test_anonymize_reaches_every_user_and_chat(tmp_path):
+    recorder = UpdateRecorder(str(tmp_path / 'updates.jsonl.gz'), salt='test')
+    user = {'id': 42, 'is_bot': False, 'first_name': 'Real', 'username': 'real'}
+    data = recorder.anonymize({
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': -100, 'type': 'group', 'title': 'Family'},
+            'from': user,
+            'new_chat_members': [user, {'id': 43, 'is_bot': False, 'first_name': 'Other'}],
+            'left_chat_member': user,
+            'contact': {'user_id': 42, 'phone_number': '+100', 'first_name': 'Real'},
+        },
+        'callback_query': {'id': '7', 'chat_instance': '-123456', 'from': user},
+    })
+
+    text = str(data)
+    assert 'Real' not in text and 'real' not in text and 'Family' not in text and '+100' not in text
+    assert "'id': 42" not in text and "'user_id': 42" not in text
+    message = data['message']
+    assert message['new_chat_members'][0]['id'] == message['from']['id'] == message['left_chat_member']['id']
+    assert message['contact']['user_id'] == message['from']['id']
+    assert message['chat']['id'] < 0
+    assert data['callback_query']['chat_instance'] != '-123456'
+    assert data['callback_query']['id'] == '7'
+    recorder.close()
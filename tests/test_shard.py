@@ -0,0 +1,130 @@
+import collections
+import os
+import sqlite3
+
+import pytest
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import bot
+import shard
+from replay import StubRequest
+
+USERS = 7
+UPDATES = 300
+
+async def record_order(update, context):
+    """Log (user_id, update_id) in the order this worker handles updates"""
+    with open(os.path.join(os.environ['SHARD_TEST_OUT'], f"seen.{os.getpid()}"), 'a') as seen:
+        seen.write(f"{update.effective_user.id} {update.update_id}\n")
+
+def build_recording_application(updater=True):
+    """Worker Application with a stubbed Bot API and an order-recording handler"""
+    application = bot.build_application(updater=updater, request=StubRequest())
+    application.add_handler(TypeHandler(Update, record_order), group=-2)
+    return application
+
+def test_shard_for_is_stable():
+    assert shard.shard_for(None, 4) == 0
+    assert shard.shard_for(5, 4) == shard.shard_for(-5, 4) == 1
+
+def test_shard_path():
+    assert shard.shard_path(2, 'data/game.db') == os.path.join('data', 'game.shard2.db')
+    assert shard.shard_path(0, 'updates.jsonl.gz') == 'updates.shard0.jsonl.gz'
+
+def test_workers_keep_per_user_order(tmp_path, monkeypatch, callback_update):
+    monkeypatch.setenv('SHARD_TEST_OUT', str(tmp_path))
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'game.db'))
+    monkeypatch.delenv('RECORD_UPDATES', raising=False)
+
+    workers, inboxes, outbox = shard.start_workers(3, build_application=build_recording_application)
+    routed = collections.defaultdict(list)
+    try:
+        for update_id in range(UPDATES):
+            user_id = 100 + update_id % USERS
+            index = shard.route(callback_update(user_id, 'easy', update_id=update_id), inboxes)
+            routed[user_id].append((index, update_id))
+    finally:
+        shard.stop_workers(workers, inboxes, outbox)
+    assert all(worker.exitcode == 0 for worker in workers)
+
+    seen = collections.defaultdict(list)
+    owners = collections.defaultdict(set)
+    for log in tmp_path.glob('seen.*'):
+        for line in log.read_text().splitlines():
+            user_id, update_id = map(int, line.split())
+            seen[user_id].append(update_id)
+            owners[user_id].add(log.name)
+
+    assert sum(map(len, seen.values())) == UPDATES
+    for user_id, handled in seen.items():
+        assert handled == [update_id for _, update_id in routed[user_id]]
+        assert len(owners[user_id]) == 1
+        assert len({index for index, _ in routed[user_id]}) == 1
+
+def _seed(db_path, users):
+    conn = sqlite3.connect(db_path)
+    for user_id in users:
+        conn.execute('INSERT INTO users (user_id, first_name, total_points) VALUES (?, ?, ?)',
+                     (user_id, f"u{user_id}", user_id * 10))
+        conn.execute('INSERT INTO user_activity (user_id, points) VALUES (?, ?)', (user_id, 10))
+        conn.execute('INSERT INTO achievements (user_id, achievement_id) VALUES (?, ?)', (user_id, 'first'))
+    conn.execute('INSERT INTO users_cold (user_id, first_name) VALUES (?, ?)', (999, 'cold'))
+    conn.execute('INSERT INTO duels (player1, player2, score1, score2, winner) VALUES (1, 2, 3, 1, 1)')
+    conn.commit()
+    conn.close()
+
+def _user_ids(db_path, table='users'):
+    conn = sqlite3.connect(db_path)
+    try:
+        return sorted(row[0] for row in conn.execute(f'SELECT user_id FROM {table}'))
+    finally:
+        conn.close()
+
+def test_split_and_merge_keep_every_row(tmp_path, db_path):
+    users = list(range(1, 21))
+    _seed(db_path, users)
+
+    targets = shard.split_database(3, db_path)
+    for index, target in enumerate(targets):
+        expected = [user_id for user_id in users if shard.shard_for(user_id, 3) == index]
+        assert _user_ids(target) == expected
+        assert _user_ids(target, 'user_activity') == expected
+    assert _user_ids(targets[shard.shard_for(999, 3)], 'users_cold') == [999]
+    with pytest.raises(FileExistsError):
+        shard.split_database(3, db_path)
+    with pytest.raises(RuntimeError):
+        shard.check_layout(targets[0], 0, 4)
+
+    os.rename(db_path, str(tmp_path / 'old.db'))
+    shard.merge_databases(db_path)
+    assert not any(os.path.exists(target) for target in targets)
+    assert _user_ids(db_path) == users
+    assert _user_ids(db_path, 'user_activity') == users
+    assert _user_ids(db_path, 'achievements') == users
+    assert _user_ids(db_path, 'users_cold') == [999]
+
+def _activity(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return sorted(conn.execute('SELECT user_id, points FROM user_activity'))
+    finally:
+        conn.close()
+
+def test_restore_after_merge_keeps_other_users_activity(tmp_path, db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO users (user_id, last_activity) VALUES (2, datetime('now', '-200 days'))")
+    conn.execute('INSERT INTO users (user_id) VALUES (3)')
+    conn.executemany('INSERT INTO user_activity (user_id, points) VALUES (?, ?)',
+                     [(2, 20), (3, 30), (3, 31), (3, 32)])
+    conn.commit()
+    conn.close()
+    assert bot.archive_inactive_users(days=90) == 1
+
+    shard.split_database(2, db_path)
+    os.rename(db_path, str(tmp_path / 'old.db'))
+    shard.merge_databases(db_path)
+    bot.update_user_stats(2, None, 'u2', None, correct=True, points=10)
+
+    assert _activity(db_path) == [(2, 10), (2, 20), (3, 30), (3, 31), (3, 32)]